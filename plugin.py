@@ -1,22 +1,36 @@
 from typing import cast
+from bisect import bisect_right
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from Default.exec import ExecCommand  # type: ignore
-from glob import iglob
+from html import escape
 from os import makedirs
 from os.path import isfile
 from os.path import join
 from os.path import realpath
+from xml.etree import ElementTree
+import hashlib
+import heapq
 import json
 import os
+import re
 import shlex
+import shutil
+import statistics
 import sublime
 import sublime_plugin
 import subprocess
-from typing import Dict, List, Union, Optional, Any, Callable
+import threading
+import time
+from typing import Dict, List, Union, Optional, Any, Callable, Tuple
 
 
 QUERY = {
     "requests": [
         {"kind": "codemodel",  "version": 2},
+        {"kind": "cache",      "version": 2},
+        {"kind": "cmakeFiles", "version": 1},
+        {"kind": "toolchains", "version": 1},
     ]
 }  # type: Dict[str, Any]
 
@@ -64,15 +78,28 @@ def check_output(shell_cmd, env=None, cwd=None):
     return outs.decode("utf-8")
 
 
-def get_vcvarsall_path(desired_vs_major_version: int) -> str:
+def write_json_atomic(path: str, data: Any) -> bool:
+    """Replaces a JSON file in one step; failures are logged, not raised."""
+    tmp = path + ".tmp"
+    try:
+        makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w") as fp:
+            json.dump(data, fp, check_circular=False)
+        os.replace(tmp, path)
+        return True
+    except OSError as ex:
+        log("unable to write", path, ex)
+        return False
+
+
+def get_vs_installation(desired_vs_major_version: int) -> 'Dict[str, str]':
     if desired_vs_major_version < 15:
         raise ValueError("major versions less than 15 (2017) are not supported")
     for vs in get_all_vs_installed_versions():
-        path = vs["path"]
         version = vs["version"]
         major_version = int(version.split(".")[0])
         if major_version == desired_vs_major_version:
-            return join(path, "VC", "Auxiliary", "Build", "vcvarsall.bat")
+            return vs
     raise RuntimeError(
         " ".join((
             "cannot find a visual studio SDK for major version",
@@ -81,6 +108,11 @@ def get_vcvarsall_path(desired_vs_major_version: int) -> str:
     )
 
 
+def get_vcvarsall_path(desired_vs_major_version: int) -> str:
+    vs = get_vs_installation(desired_vs_major_version)
+    return join(vs["path"], "VC", "Auxiliary", "Build", "vcvarsall.bat")
+
+
 def parse_vcvarsall(vcvarsall_path: str,
                     target_architecture: str,
                     host_architecture: str) -> 'Dict[str, str]':
@@ -105,11 +137,72 @@ def parse_vcvarsall(vcvarsall_path: str,
     return result
 
 
+class VsEnvironmentCache:
+    """Remembers the environments of vcvarsall.bat across sessions."""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__entries = None  # type: Optional[Dict[str, Dict[str, str]]]
+
+    @staticmethod
+    def path() -> str:
+        return join(sublime.cache_path(), "CMakeBuilder",
+                    "vs_environments.json")
+
+    def get(self, vcvarsall_path: str, version: str, host_architecture: str,
+            target_architecture: str) -> 'Dict[str, str]':
+        try:
+            mtime = os.stat(vcvarsall_path).st_mtime_ns
+        except OSError:
+            mtime = 0
+        prefix = "|".join((version, host_architecture, target_architecture))
+        key = "{}|{}".format(prefix, mtime)
+        with self.__lock:
+            entries = self.__load()
+            env = entries.get(key)
+            if env is None:
+                log("running", vcvarsall_path, host_architecture,
+                    target_architecture)
+                env = parse_vcvarsall(vcvarsall_path,
+                                      target_architecture=target_architecture,
+                                      host_architecture=host_architecture)
+                for stale in [k for k in entries if k.startswith(prefix + "|")]:
+                    del entries[stale]
+                entries[key] = env
+                self.__save()
+            return dict(env)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries = {}
+            try:
+                os.remove(self.path())
+            except FileNotFoundError:
+                pass
+
+    def __load(self) -> 'Dict[str, Dict[str, str]]':
+        if self.__entries is None:
+            try:
+                with open(self.path(), "r") as fp:
+                    self.__entries = json.load(fp)
+            except (OSError, ValueError):
+                self.__entries = {}
+        return cast(dict, self.__entries)
+
+    def __save(self) -> None:
+        write_json_atomic(self.path(), self.__entries)
+
+
+vs_environments = VsEnvironmentCache()
+
+
 def get_vs_env(desired_vs_major_version: int,
                host_architecture: str,
                target_architecture: str) -> 'Dict[str, str]':
-    return parse_vcvarsall(
+    vs = get_vs_installation(desired_vs_major_version)
+    return vs_environments.get(
         get_vcvarsall_path(desired_vs_major_version),
+        vs["version"],
         host_architecture,
         target_architecture)
 
@@ -155,7 +248,37 @@ def get_all_vs_generator_names(cmake_binary: str):
     return result
 
 
-def get_all_vs_installed_versions():
+class ToolchainRegistry:
+    """Caches the results of toolchain discovery for the session."""
+
+    def __init__(self) -> None:
+        self.__lock = threading.RLock()
+        self.__values = {}  # type: Dict[Tuple[Any, ...], Any]
+
+    def get(self, key: 'Tuple[Any, ...]', compute: 'Callable[[], Any]') -> Any:
+        with self.__lock:
+            try:
+                return self.__values[key]
+            except KeyError:
+                value = compute()
+                self.__values[key] = value
+                return value
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__values.clear()
+
+
+toolchains = ToolchainRegistry()
+
+
+def get_all_vs_installed_versions() -> 'List[Dict[str, str]]':
+    return toolchains.get(("vs_installed_versions",),
+                          _discover_vs_installed_versions)
+
+
+def _discover_vs_installed_versions() -> 'List[Dict[str, str]]':
+    log("running vswhere")
     cwd = join(os.environ["PROGRAMFILES(X86)"], "Microsoft Visual Studio",
                "Installer")
     cmd = "vswhere.exe -prerelease -legacy -format json -utf8"
@@ -165,6 +288,12 @@ def get_all_vs_installed_versions():
 
 
 def get_default_vs_generator_name(cmake_binary: str) -> str:
+    return toolchains.get(
+        ("default_vs_generator", binary_identity(cmake_binary)),
+        lambda: _discover_default_vs_generator_name(cmake_binary))
+
+
+def _discover_default_vs_generator_name(cmake_binary: str) -> str:
     names = get_all_vs_generator_names(cmake_binary)
     f = get_vs_major_version_from_generator_str
     versions = [f(cmake_binary, n) for n in names]
@@ -176,13 +305,129 @@ def get_default_vs_generator_name(cmake_binary: str) -> str:
     raise RuntimeError("unable to find default MSVC generator name")
 
 
+def discover_toolchains() -> None:
+    if sublime.platform() != "windows":
+        return
+    try:
+        get_default_vs_generator_name(get_cmake_binary(None))
+    except Exception as ex:
+        log("toolchain discovery failed:", ex)
+
+
+def binary_identity(binary: str) -> 'Tuple[str, int, int]':
+    """Identifies an executable by its resolved path, mtime and size."""
+    path = shutil.which(binary)
+    if path:
+        try:
+            path = realpath(path)
+            st = os.stat(path)
+            return path, st.st_mtime_ns, st.st_size
+        except OSError:
+            pass
+    return binary, 0, 0
+
+
+# Parsed output of "cmake -E capabilities", keyed by binary_identity.
+_capabilities_cache = {}  # type: Dict[Tuple[str, int, int], Dict[str, Any]]
+_capabilities_lock = threading.Lock()
+
+
+def load_capabilities(cmake_binary: str) -> 'Dict[str, Any]':
+    identity = binary_identity(cmake_binary)
+    with _capabilities_lock:
+        result = _capabilities_cache.get(identity)
+        if result is not None:
+            return result
+        log("running", cmake_binary, "-E capabilities")
+        command = "{} -E capabilities".format(cmake_binary)
+        result = json.loads(check_output(command))
+        if "error" in result:
+            raise ValueError("Error loading capabilities")
+        # An upgraded binary has the same path but a different mtime or size;
+        # forget about the stale entries for it.
+        for stale in [k for k in _capabilities_cache if k[0] == identity[0]]:
+            del _capabilities_cache[stale]
+        _capabilities_cache[identity] = result
+        return result
+
+
 def capabilities(cmake_binary: str, key: str) -> Union[None, List[str], str, Dict[str, str]]:
-    command = "{} -E capabilities".format(cmake_binary)
-    capabilities = json.loads(check_output(command))
-    if "error" in capabilities:
-        raise ValueError("Error loading capabilities")
+    return load_capabilities(cmake_binary).get(key, None)
+
+
+def available_memory() -> 'Optional[int]':
+    """The physical memory in bytes that is available, if known."""
+    platform = sublime.platform()
+    try:
+        if platform == "linux":
+            with open("/proc/meminfo", "r") as fp:
+                for line in fp:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        elif platform == "windows":
+            import ctypes
+
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [
+                    ("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+                ]
+
+            status = MemoryStatus()
+            status.dwLength = ctypes.sizeof(MemoryStatus)
+            windll = getattr(ctypes, "windll")
+            if windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.ullAvailPhys
+        else:
+            # macOS has no cheap notion of available memory; assume half of
+            # the physical memory is.
+            output = subprocess.check_output(["sysctl", "-n", "hw.memsize"])
+            return int(output.strip()) // 2
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        log("unable to determine the available memory:", e)
+    return None
+
+
+# Rough memory use of a single compiler or test process, for "auto" jobs.
+BUILD_JOB_MEMORY = 1 << 30
+TEST_JOB_MEMORY = 1 << 28
+
+
+def parallel_jobs(value: 'Union[None, int, str]', auto_jobs: int,
+                  job_memory: int) -> 'Optional[int]':
+    """Resolves a build_parallel_jobs or ctest_parallel_jobs setting."""
+    if value is None:
+        return None
+    if value != "auto":
+        try:
+            return max(1, int(value))
+        except (TypeError, ValueError):
+            log("invalid number of parallel jobs:", value)
+            return None
+    memory = available_memory()
+    if memory is not None:
+        auto_jobs = min(auto_jobs, memory // job_memory)
+    return max(1, auto_jobs)
+
+
+def build_jobs(value: 'Union[None, int, str]',
+               gen: 'Generator') -> 'Optional[int]':
+    return parallel_jobs(value, gen.auto_jobs(os.cpu_count() or 1),
+                         BUILD_JOB_MEMORY)
+
+
+def test_jobs(value: 'Union[None, int, str]') -> 'Optional[int]':
+    return parallel_jobs(value, os.cpu_count() or 1, TEST_JOB_MEMORY)
 
-    return capabilities.get(key, None)
+
+_patterns = {}  # type: Dict[str, Any]
 
 
 class Generator:
@@ -193,6 +438,18 @@ class Generator:
     def regex(self) -> str:
         raise NotImplementedError()
 
+    def auto_jobs(self, cpus: int) -> int:
+        """The number of parallel build jobs for "auto", ignoring memory."""
+        return cpus
+
+    def pattern(self) -> 'Any':
+        """The compiled regex(). It is compiled once per process."""
+        regex = self.regex()
+        compiled = _patterns.get(regex)
+        if compiled is None:
+            compiled = _patterns[regex] = re.compile(regex)
+        return compiled
+
 
 class NinjaGenerator(Generator):
 
@@ -208,6 +465,10 @@ class NinjaGenerator(Generator):
         else:
             return r'(.+[^:]):(\d+):(\d+):\s*(.+)$'
 
+    def auto_jobs(self, cpus: int) -> int:
+        # The same as Ninja's own default.
+        return cpus + 2 if cpus > 2 else cpus + 1
+
 
 class UnixMakefilesGenerator(Generator):
 
@@ -223,7 +484,7 @@ class NMakeMakefilesGenerator(Generator):
     def syntax(self) -> str:
         return syntax("Make")
 
-    def file_regex(self) -> str:
+    def regex(self) -> str:
         return r'^(.+)\((\d+)\):() (.+)$'
 
 
@@ -236,10 +497,8 @@ class VisualStudioGenerator(Generator):
         return r'^\s*(.+)\((\d+),?(\d*)\)\s*:\s*(.+)$'
 
 
-def make_generator(build_folder: str, generator: Optional[str]) -> Generator:
-    if generator is None:
-        generator = load_reply(build_folder)["cmake"]["generator"]["name"]
-    elif generator == "Ninja":
+def generator_for_name(generator: str) -> Generator:
+    if generator == "Ninja":
         return NinjaGenerator()
     elif generator == "NMake Makefiles":
         return NMakeMakefilesGenerator()
@@ -250,6 +509,363 @@ def make_generator(build_folder: str, generator: Optional[str]) -> Generator:
     raise KeyError("unknown generator")
 
 
+# build folder -> (index file the generator was read from, generator)
+_generators = {}  # type: Dict[str, Tuple[str, Generator]]
+
+
+def make_generator(build_folder: str, generator: Optional[str]) -> Generator:
+    if generator is not None:
+        return generator_for_name(generator)
+    # The generator of a build folder only changes when CMake writes a new
+    # index file, so there is no need to look at the reply on every build.
+    index_file = get_index_file(build_folder)
+    cached = _generators.get(build_folder)
+    if cached is not None and cached[0] == index_file:
+        return cached[1]
+    reply = load_reply_model(build_folder)
+    gen = generator_for_name(reply.generator_name)
+    _generators[build_folder] = (reply.index_file, gen)
+    return gen
+
+
+class BuildOutputFilter:
+    """Reduces the output of a build to its diagnostics and progress."""
+
+    PROGRESS = re.compile(r'^\[\s*(?:(\d+)/(\d+)|(\d+)%)\]')
+    FAILURE = re.compile(r'^(?:FAILED:|ninja: |make(?:\[\d+\])?: \*\*\*|'
+                         r'CMake (?:Error|Warning))')
+    CONTEXT_BEFORE = 2
+    CONTEXT_AFTER = 4
+
+    def __init__(self, pattern: 'Any') -> None:
+        self.__diagnostic = pattern
+        self.__partial = ""
+        self.__before = []  # type: List[str]
+        self.__after = 0
+        self.progress = None  # type: Optional[str]
+        self.hidden = 0
+
+    def feed(self, data: str) -> str:
+        """Returns the part of data that should go to the output panel."""
+        lines = (self.__partial + data).split("\n")
+        self.__partial = lines.pop()
+        return self.__filter(lines)
+
+    def flush(self) -> str:
+        """Returns whatever is left after the build finished."""
+        lines = [self.__partial] if self.__partial else []
+        self.__partial = ""
+        text = self.__filter(lines)
+        self.hidden += len(self.__before)
+        self.__before = []
+        return text
+
+    def __filter(self, lines: 'List[str]') -> str:
+        kept = []  # type: List[str]
+        for line in lines:
+            match = self.PROGRESS.match(line)
+            if match:
+                if match.group(3) is None:
+                    self.progress = "{}/{}".format(match.group(1),
+                                                   match.group(2))
+                else:
+                    self.progress = match.group(3) + "%"
+                self.hidden += 1
+                continue
+            if self.__diagnostic.match(line) or self.FAILURE.match(line):
+                kept.extend(self.__before)
+                self.__before = []
+                kept.append(line)
+                self.__after = self.CONTEXT_AFTER
+            elif self.__after > 0:
+                kept.append(line)
+                self.__after -= 1
+            else:
+                if len(self.__before) == self.CONTEXT_BEFORE:
+                    self.hidden += 1
+                    del self.__before[0]
+                self.__before.append(line)
+        return "".join(line + "\n" for line in kept)
+
+
+class Diagnostic:
+    __slots__ = ("file", "line", "col", "severity", "message")
+
+    def __init__(self, file: str, line: int, col: int, severity: str,
+                 message: str) -> None:
+        self.file = file
+        self.line = line
+        self.col = col
+        self.severity = severity
+        self.message = message
+
+
+class DiagnosticIndex:
+    """The diagnostics of a build, collected while its output arrives."""
+
+    SEVERITY = re.compile(r'(fatal error|error|warning|note)\b', re.I)
+
+    def __init__(self, pattern: 'Any', working_dir: str) -> None:
+        self.__pattern = pattern
+        self.__working_dir = working_dir
+        self.__partial = ""
+        self.__position = -1
+        self.diagnostics = []  # type: List[Diagnostic]
+        self.by_file = {}  # type: Dict[str, List[Diagnostic]]
+
+    def feed(self, data: str) -> None:
+        lines = (self.__partial + data).split("\n")
+        self.__partial = lines.pop()
+        for line in lines:
+            self.__match(line)
+
+    def flush(self) -> None:
+        if self.__partial:
+            self.__match(self.__partial)
+            self.__partial = ""
+
+    def __match(self, line: str) -> None:
+        match = self.__pattern.match(line.rstrip("\r"))
+        if not match:
+            return
+        file, row, col, message = match.groups()
+        file = os.path.normpath(join(self.__working_dir, file.strip()))
+        severity = self.SEVERITY.search(message)
+        diagnostic = Diagnostic(
+            file, int(row), int(col) if col else 0,
+            severity.group(1).lower() if severity else "error",
+            message.strip())
+        self.diagnostics.append(diagnostic)
+        self.by_file.setdefault(os.path.normcase(file), []).append(diagnostic)
+
+    def of_file(self, file_name: str) -> 'List[Diagnostic]':
+        return self.by_file.get(os.path.normcase(file_name), [])
+
+    def step(self, forward: bool) -> 'Optional[Diagnostic]':
+        """Moves to the next (or previous) diagnostic, wrapping around."""
+        if not self.diagnostics:
+            return None
+        self.__position += 1 if forward else -1
+        self.__position %= len(self.diagnostics)
+        return self.diagnostics[self.__position]
+
+
+# window id -> the diagnostics of the last build in that window
+_diagnostics = {}  # type: Dict[int, DiagnosticIndex]
+
+DIAGNOSTIC_SCOPES = {
+    "fatal error": "region.redish",
+    "error": "region.redish",
+    "warning": "region.yellowish",
+    "note": "region.bluish",
+}
+
+
+def mark_diagnostics(view: sublime.View, index: DiagnosticIndex) -> None:
+    """Shows the diagnostics of the view's file as gutter icons."""
+    file_name = view.file_name()
+    diagnostics = index.of_file(file_name) if file_name else []
+    by_scope = {}  # type: Dict[str, List[sublime.Region]]
+    for d in diagnostics:
+        scope = DIAGNOSTIC_SCOPES.get(d.severity, "region.redish")
+        point = view.text_point(d.line - 1, 0)
+        by_scope.setdefault(scope, []).append(view.line(point))
+    for scope in set(DIAGNOSTIC_SCOPES.values()):
+        key = "cmakebuilder_" + scope
+        regions = by_scope.get(scope)
+        if regions:
+            view.add_regions(key, regions, scope, "dot",
+                             sublime.HIDDEN | sublime.PERSISTENT)
+        else:
+            view.erase_regions(key)
+
+
+def mark_all_diagnostics(window: sublime.Window) -> None:
+    index = _diagnostics.get(window.id())
+    if index is None:
+        return
+    for view in window.views():
+        mark_diagnostics(view, index)
+
+
+class NinjaEdge:
+    __slots__ = ("start", "end", "outputs")
+
+    def __init__(self, start: int, end: int, output: str) -> None:
+        self.start = start
+        self.end = end
+        self.outputs = [output]
+
+    @property
+    def duration(self) -> int:
+        return self.end - self.start
+
+
+class NinjaLog:
+    """The edges of the last build recorded in a .ninja_log."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__start = None  # type: Optional[Tuple[int, int]]
+        self.__reset(0)
+
+    def __reset(self, offset: int) -> None:
+        self.__offset = offset
+        self.__inode = None  # type: Optional[int]
+        self.__last_end = -1
+        self.edges = {}  # type: Dict[Tuple[int, int, str], NinjaEdge]
+
+    def update(self, start: 'Optional[Tuple[int, int]]' = None) -> None:
+        """Reads the entries appended to the log since the last call."""
+        st = os.stat(self.path)
+        if (start != self.__start or st.st_ino != self.__inode or
+                st.st_size < self.__offset):
+            # A new build, or Ninja rewrote ("recompacted") the log.
+            self.__start = start
+            offset = 0
+            if start and start[0] == st.st_ino and start[1] <= st.st_size:
+                offset = start[1]
+            self.__reset(offset)
+            self.__inode = st.st_ino
+        if st.st_size == self.__offset:
+            return
+        with open(self.path, "rb") as fp:
+            fp.seek(self.__offset)
+            data = fp.read()
+        # Leave an incomplete last line for the next update.
+        end = data.rfind(b"\n") + 1
+        self.__offset += end
+        for line in data[:end].decode("utf-8", "replace").splitlines():
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) != 5:
+                continue
+            start_ms, stop = int(fields[0]), int(fields[1])
+            if stop < self.__last_end:
+                self.edges = {}
+            self.__last_end = stop
+            # Edges with several outputs have one line per output.
+            key = (start_ms, stop, fields[4])
+            edge = self.edges.get(key)
+            if edge is None:
+                self.edges[key] = NinjaEdge(start_ms, stop, fields[3])
+            else:
+                edge.outputs.append(fields[3])
+
+
+def ninja_build_start_file(build_folder: str) -> str:
+    return join(data_folder(build_folder), "ninja_build_start.json")
+
+
+def mark_ninja_build_start(build_folder: str) -> None:
+    """Records where the entries of the build about to start will begin."""
+    try:
+        st = os.stat(join(build_folder, ".ninja_log"))
+        start = [st.st_ino, st.st_size]
+    except FileNotFoundError:
+        # Ninja creates the log; the build starts at its beginning.
+        start = [0, 0]
+    except OSError as e:
+        log("unable to read the size of .ninja_log:", e)
+        return
+    write_json_atomic(ninja_build_start_file(build_folder), start)
+
+
+def load_ninja_build_start(build_folder: str) -> 'Optional[Tuple[int, int]]':
+    try:
+        with open(ninja_build_start_file(build_folder), "r") as fp:
+            inode, size = json.load(fp)
+    except (OSError, ValueError, TypeError):
+        return None
+    if inode == 0:
+        # The log did not exist yet; whatever inode it got now is the one.
+        try:
+            inode = os.stat(join(build_folder, ".ninja_log")).st_ino
+        except OSError:
+            return None
+    return inode, size
+
+
+_ninja_logs = {}  # type: Dict[str, NinjaLog]
+
+
+def load_ninja_log(build_folder: str) -> NinjaLog:
+    path = join(build_folder, ".ninja_log")
+    log_ = _ninja_logs.get(path)
+    if log_ is None:
+        log_ = _ninja_logs[path] = NinjaLog(path)
+    log_.update(load_ninja_build_start(build_folder))
+    return log_
+
+
+OBJECT_DIR = re.compile(r'(?:^|/)CMakeFiles/([^/]+)\.dir/')
+
+
+def output_owners(build_folder: str) -> 'Callable[[str], str]':
+    """Returns a function that maps a Ninja output path to a target name."""
+    artifacts = {}  # type: Dict[str, str]
+    for summary in load_cached_target_summaries(build_folder).values():
+        for artifact in summary.get("artifacts", []):
+            artifacts[artifact["path"]] = summary["name"]
+
+    def owner(output: str) -> str:
+        output = output.replace("\\", "/")
+        match = OBJECT_DIR.search(output)
+        if match:
+            return match.group(1)
+        return artifacts.get(output, "(other)")
+
+    return owner
+
+
+def critical_path(edges: 'List[NinjaEdge]') -> 'List[NinjaEdge]':
+    """Approximates the critical path of a build from the end times."""
+    by_end = sorted(edges, key=lambda e: e.end)
+    ends = [e.end for e in by_end]
+    if not by_end:
+        return []
+    path = [by_end[-1]]
+    while True:
+        i = bisect_right(ends, path[-1].start)
+        if i == 0:
+            break
+        path.append(by_end[i - 1])
+    path.reverse()
+    return path
+
+
+def build_profile(build_folder: str) -> 'Dict[str, Any]':
+    edges = list(load_ninja_log(build_folder).edges.values())
+    if not edges:
+        return {"edges": 0}
+    start = min(e.start for e in edges)
+    wall = max(e.end for e in edges) - start
+    busy = sum(e.duration for e in edges)
+    # The number of edges running at the same time, at its peak.
+    events = sorted([(e.start, 1) for e in edges] +
+                    [(e.end, -1) for e in edges])
+    running = peak = 0
+    for _, delta in events:
+        running += delta
+        peak = max(peak, running)
+    owner = output_owners(build_folder)
+    targets = {}  # type: Dict[str, List[int]]
+    for e in edges:
+        totals = targets.setdefault(owner(e.outputs[0]), [0, 0])
+        totals[0] += e.duration
+        totals[1] += 1
+    return {
+        "edges": len(edges),
+        "wall": wall,
+        "busy": busy,
+        "peak": peak,
+        "targets": sorted(targets.items(), key=lambda t: -t[1][0]),
+        "slowest": heapq.nlargest(20, edges, key=lambda e: e.duration),
+        "critical_path": critical_path(edges),
+    }
+
+
 def file_api(build_folder: str) -> str:
     return join(build_folder, ".cmake", "api", "v1")
 
@@ -262,12 +878,13 @@ def file_api_reply(build_folder: str) -> str:
     return join(file_api(build_folder), "reply")
 
 
-def ensure_query_path_exists(build_folder: str) -> None:
-    makedirs(file_api_query(build_folder), exist_ok=True)
+def data_folder(build_folder: str) -> str:
+    """Where CMakeBuilder keeps its own caches for a build folder."""
+    return join(build_folder, "CMakeFiles", "CMakeBuilder")
 
 
-def expand_vars(window: sublime.Window, d) -> 'Any':
-    return sublime.expand_variables(d, window.extract_variables())
+def ensure_query_path_exists(build_folder: str) -> None:
+    makedirs(file_api_query(build_folder), exist_ok=True)
 
 
 def write_query(window: sublime.Window, build_folder: str) -> None:
@@ -276,20 +893,839 @@ def write_query(window: sublime.Window, build_folder: str) -> None:
         json.dump(QUERY, fp, check_circular=False)
 
 
+_index_files = {}  # type: Dict[str, Tuple[int, str]]
+
+
 def get_index_file(build_folder: str) -> str:
-    path = join(file_api_reply(build_folder), "index-")
+    """Returns the path of the current index file of the reply folder."""
+    reply_folder = file_api_reply(build_folder)
+    try:
+        mtime = os.stat(reply_folder).st_mtime_ns
+    except OSError:
+        raise IndexError("no reply folder in " + build_folder)
+    cached = _index_files.get(reply_folder)
+    # On filesystems with coarse or cached mtimes CMake can replace the index
+    # without the mtime of the folder changing, so also check that it exists.
+    if cached is not None and cached[0] == mtime and isfile(cached[1]):
+        return cached[1]
     # Whenever a new index file is generated it is given a new name and any old
     # one is deleted. During the short time between these steps there may be
     # multiple index files present; the one with the largest name in
     # lexicographic order is the current index file.
-    return sorted(iglob(path + "*.json"), reverse=True)[0]
+    name = ""
+    with os.scandir(reply_folder) as it:
+        for entry in it:
+            if (entry.name > name and entry.name.startswith("index-") and
+                    entry.name.endswith(".json")):
+                name = entry.name
+    if not name:
+        raise IndexError("no index file in " + reply_folder)
+    index_file = join(reply_folder, name)
+    _index_files[reply_folder] = (mtime, index_file)
+    return index_file
+
+
+class ReplyObject:
+    """An object of a file API reply. Its JSON is read on first access."""
+
+    def __init__(self, reply_folder: str, response: 'Dict[str, Any]') -> None:
+        self.kind = response["kind"]  # type: str
+        self.version = response["version"]  # type: Dict[str, int]
+        self.json_file = response["jsonFile"]  # type: str
+        self.__path = join(reply_folder, self.json_file)
+        self.__data = None  # type: Optional[Dict[str, Any]]
+
+    @property
+    def data(self) -> 'Dict[str, Any]':
+        if self.__data is None:
+            log("loading", self.json_file)
+            with open(self.__path, "r") as fp:
+                self.__data = json.load(fp)
+        return self.__data
+
+
+class CodeModelReply(ReplyObject):
+
+    @property
+    def source_folder(self) -> str:
+        return self.data["paths"]["source"]
+
+    @property
+    def configurations(self) -> 'List[Dict[str, Any]]':
+        return self.data["configurations"]
+
+
+class CacheReply(ReplyObject):
+
+    def __init__(self, reply_folder: str, response: 'Dict[str, Any]') -> None:
+        super().__init__(reply_folder, response)
+        self.__entries = None  # type: Optional[Dict[str, str]]
+
+    def entries(self) -> 'Dict[str, str]':
+        if self.__entries is None:
+            self.__entries = {e["name"]: e["value"]
+                              for e in self.data["entries"]}
+        return self.__entries
+
+    def get(self, name: str,
+            default: 'Optional[str]' = None) -> 'Optional[str]':
+        return self.entries().get(name, default)
+
+
+class ToolchainsReply(ReplyObject):
+
+    def compiler_paths(self) -> 'Dict[str, str]':
+        return {t["language"]: t["compiler"]["path"]
+                for t in self.data["toolchains"]
+                if "path" in t["compiler"]}
+
+
+class CMakeFilesReply(ReplyObject):
+
+    @property
+    def source_folder(self) -> str:
+        return self.data["paths"]["source"]
+
+    @property
+    def inputs(self) -> 'List[Dict[str, Any]]':
+        return self.data["inputs"]
+
+
+REPLY_OBJECT_TYPES = {
+    "codemodel": CodeModelReply,
+    "cache": CacheReply,
+    "toolchains": ToolchainsReply,
+    "cmakeFiles": CMakeFilesReply,
+}  # type: Dict[str, type]
+
+
+class Reply:
+    """The file API reply of a build folder, decoded on demand."""
+
+    def __init__(self, build_folder: str, index_file: str) -> None:
+        self.index_file = index_file
+        with open(index_file, "r") as fp:
+            self.index = json.load(fp)  # type: Dict[str, Any]
+        reply_folder = file_api_reply(build_folder)
+        self.responses = []  # type: List[Dict[str, Any]]
+        self.__objects = {}  # type: Dict[str, ReplyObject]
+        try:
+            query = self.index["reply"][CLIENT_STR]["query.json"]
+            self.responses = query["responses"]
+        except KeyError:
+            log("no responses for", CLIENT_STR, "in", index_file)
+        for response in self.responses:
+            if "error" in response:
+                log("file api error:", response["error"])
+                continue
+            kind = response["kind"]
+            cls = REPLY_OBJECT_TYPES.get(kind, ReplyObject)
+            self.__objects[kind] = cls(reply_folder, response)
+
+    @property
+    def generator_name(self) -> str:
+        return self.index["cmake"]["generator"]["name"]
+
+    def get(self, kind: str) -> 'Optional[ReplyObject]':
+        return self.__objects.get(kind)
+
+    def objects(self) -> 'List[ReplyObject]':
+        return list(self.__objects.values())
+
+    @property
+    def codemodel(self) -> 'Optional[CodeModelReply]':
+        return cast(Optional[CodeModelReply], self.get("codemodel"))
+
+    @property
+    def cache(self) -> 'Optional[CacheReply]':
+        return cast(Optional[CacheReply], self.get("cache"))
+
+    @property
+    def toolchains(self) -> 'Optional[ToolchainsReply]':
+        return cast(Optional[ToolchainsReply], self.get("toolchains"))
+
+    @property
+    def cmake_files(self) -> 'Optional[CMakeFilesReply]':
+        return cast(Optional[CMakeFilesReply], self.get("cmakeFiles"))
+
+
+_replies = {}  # type: Dict[str, Reply]
+_replies_lock = threading.Lock()
+
+
+def load_reply_model(build_folder: str) -> Reply:
+    index_file = get_index_file(build_folder)
+    with _replies_lock:
+        reply = _replies.get(build_folder)
+        if reply is None or reply.index_file != index_file:
+            reply = Reply(build_folder, index_file)
+            _replies[build_folder] = reply
+        return reply
+
+
+def input_snapshot_file(build_folder: str) -> str:
+    return join(data_folder(build_folder), "inputs.json")
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cmake_input_paths(reply: Reply) -> 'List[str]':
+    """The inputs of the cmakeFiles reply that the user can edit."""
+    cmake_files = reply.cmake_files
+    if cmake_files is None:
+        return []
+    return [join(cmake_files.source_folder, item["path"])
+            for item in cmake_files.inputs
+            if not item.get("isGenerated") and not item.get("isCMake")]
+
+
+def save_input_snapshot(build_folder: str, reply: Reply) -> None:
+    """Records the mtime, size and hash of every CMake input of a reply."""
+    if reply.cmake_files is None:
+        return
+    inputs = {}  # type: Dict[str, List[Any]]
+    for path in cmake_input_paths(reply):
+        try:
+            st = os.stat(path)
+            inputs[path] = [st.st_mtime_ns, st.st_size, hash_file(path)]
+        except OSError:
+            continue
+    write_input_snapshot(build_folder, os.path.basename(reply.index_file),
+                         inputs)
+
+
+def write_input_snapshot(build_folder: str, index_name: str,
+                         inputs: 'Dict[str, List[Any]]') -> None:
+    write_json_atomic(input_snapshot_file(build_folder),
+                      {"index": index_name, "inputs": inputs})
+
+
+def find_stale_inputs(build_folder: str) -> 'Optional[List[str]]':
+    """Returns the CMake inputs changed since the last configure, or None."""
+    try:
+        with open(input_snapshot_file(build_folder), "r") as fp:
+            snapshot = json.load(fp)
+        index_file = get_index_file(build_folder)
+        index_name = os.path.basename(index_file)
+    except (OSError, ValueError, IndexError):
+        return None
+    if snapshot.get("index") != index_name:
+        # CMake ran without us (e.g. regenerated during a build), so the
+        # inputs were up to date at that time. Files edited after that are
+        # stale, and must not become part of the new snapshot.
+        try:
+            index_mtime = os.stat(index_file).st_mtime_ns
+            reply = load_reply_model(build_folder)
+        except (OSError, ValueError, IndexError):
+            return None
+        edited = []  # type: List[str]
+        for path in cmake_input_paths(reply):
+            try:
+                if os.stat(path).st_mtime_ns > index_mtime:
+                    edited.append(path)
+            except OSError:
+                edited.append(path)
+        if edited:
+            return edited
+        log("reply changed since the last snapshot, taking a new one")
+        save_input_snapshot(build_folder, reply)
+        return []
+    inputs = snapshot["inputs"]
+    stale = []  # type: List[str]
+    touched = False
+    for path, (mtime, size, digest) in inputs.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            stale.append(path)
+            continue
+        if st.st_mtime_ns == mtime and st.st_size == size:
+            continue
+        if st.st_size == size and hash_file(path) == digest:
+            inputs[path] = [st.st_mtime_ns, size, digest]
+            touched = True
+            continue
+        stale.append(path)
+    if touched:
+        # Remember the new mtimes so that the files are not hashed again.
+        write_input_snapshot(build_folder, index_name, inputs)
+    return stale
+
+
+def get_compilers(build_folder: str) -> 'Dict[str, str]':
+    """Returns the compiler path of every enabled language, e.g. "CXX"."""
+    try:
+        reply = load_reply_model(build_folder)
+    except (OSError, ValueError, IndexError):
+        reply = None
+    if reply and reply.toolchains:
+        return reply.toolchains.compiler_paths()
+    if reply and reply.cache:
+        entries = reply.cache.entries()
+    else:
+        entries = load_cmake_cache(build_folder)
+    prefix = "CMAKE_"
+    suffix = "_COMPILER"
+    # The Visual Studio generators do not store the compilers in the cache.
+    result = load_compiler_files(build_folder)
+    result.update({
+        key[len(prefix):-len(suffix)]: value
+        for key, value in entries.items()
+        if key.startswith(prefix) and key.endswith(suffix) and value})
+    return result
+
 
+_COMPILER_FILE = re.compile(r'^CMake(\w+)Compiler\.cmake$')
+_COMPILER_SET = re.compile(r'^set\(CMAKE_(\w+)_COMPILER "([^"]+)"\)',
+                           re.MULTILINE)
 
-def load_reply(build_folder: str) -> dict:
-    with open(get_index_file(build_folder), "r") as fp:
+
+def load_compiler_files(build_folder: str) -> 'Dict[str, str]':
+    """Reads the compilers from the CMake<LANG>Compiler.cmake files."""
+    files = []  # type: List[Tuple[float, str]]
+    try:
+        with os.scandir(join(build_folder, "CMakeFiles")) as it:
+            folders = [entry.path for entry in it
+                       if entry.is_dir() and entry.name[:1].isdigit()]
+        for folder in folders:
+            with os.scandir(folder) as it:
+                files.extend((entry.stat().st_mtime, entry.path) for entry in it
+                             if _COMPILER_FILE.match(entry.name))
+    except OSError:
+        return {}
+    result = {}  # type: Dict[str, str]
+    for _, path in sorted(files):
+        try:
+            with open(path, "r") as fp:
+                text = fp.read()
+        except OSError:
+            continue
+        for language, compiler in _COMPILER_SET.findall(text):
+            result[language] = compiler
+    return result
+
+
+# The only parts of a target reply that are needed to generate build systems
+# and the target index.
+TARGET_SUMMARY_KEYS = ("name", "type", "artifacts", "nameOnDisk")
+
+
+def target_summary_cache_file(build_folder: str) -> str:
+    return join(data_folder(build_folder), "target_summaries.json")
+
+
+def load_cached_target_summaries(
+    build_folder: str
+) -> 'Dict[str, Dict[str, Any]]':
+    try:
+        with open(target_summary_cache_file(build_folder), "r") as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    if data.get("keys") != list(TARGET_SUMMARY_KEYS):
+        return {}
+    return data.get("targets", {})
+
+
+def save_cached_target_summaries(
+    build_folder: str,
+    summaries: 'Dict[str, Dict[str, Any]]'
+) -> None:
+    write_json_atomic(target_summary_cache_file(build_folder),
+                      {"keys": list(TARGET_SUMMARY_KEYS), "targets": summaries})
+
+
+_json_decoder = json.JSONDecoder()
+# The C implementation of string decoding; not part of the typeshed stubs.
+_scanstring = cast('Callable[[str, int], Tuple[str, int]]',
+                   getattr(json.decoder, "scanstring"))
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Everything up to the next bracket, stepping over complete strings.
+_JSON_UP_TO_BRACKET = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+# The indentation of the first member of a pretty-printed object.
+_JSON_MEMBER_INDENT = re.compile(r'[ \t\n\r]*\{\n([ \t]+)"')
+
+
+def _skip_json_whitespace(text: str, pos: int) -> int:
+    match = _JSON_WHITESPACE.match(text, pos)
+    assert match is not None  # the pattern matches the empty string
+    return match.end()
+
+
+def _skip_json_value(text: str, pos: int) -> int:
+    if text[pos] not in "[{":
+        return _json_decoder.raw_decode(text, pos)[1]
+    depth = 0
+    while True:
+        match = _JSON_UP_TO_BRACKET.match(text, pos)
+        assert match is not None  # the pattern matches the empty string
+        pos = match.end()
+        if text[pos] in "[{":
+            depth += 1
+        else:
+            depth -= 1
+        pos += 1
+        if depth == 0:
+            return pos
+
+
+def _scan_json_members(text: str, keys: 'Tuple[str, ...]') -> 'Dict[str, int]':
+    wanted = set(keys)
+    result = {}  # type: Dict[str, int]
+    pos = _skip_json_whitespace(text, 0)
+    if text[pos] != "{":
+        raise ValueError("expected a JSON object")
+    pos = _skip_json_whitespace(text, pos + 1)
+    while wanted and text[pos] != "}":
+        key, pos = _scanstring(text, pos + 1)
+        pos = _skip_json_whitespace(text, pos)
+        if text[pos] != ":":
+            raise ValueError("expected ':' at offset {}".format(pos))
+        pos = _skip_json_whitespace(text, pos + 1)
+        if key in wanted:
+            result[key] = pos
+            wanted.discard(key)
+        pos = _skip_json_value(text, pos)
+        pos = _skip_json_whitespace(text, pos)
+        if text[pos] == ",":
+            pos = _skip_json_whitespace(text, pos + 1)
+    return result
+
+
+def _json_member_offsets(text: str,
+                         keys: 'Tuple[str, ...]') -> 'Dict[str, int]':
+    """Returns where the values of the given top-level members start."""
+    match = _JSON_MEMBER_INDENT.match(text)
+    if not match:
+        return _scan_json_members(text, keys)
+    prefix = "\n" + match.group(1) + '"'
+    result = {}  # type: Dict[str, int]
+    for key in keys:
+        needle = prefix + key + '"'
+        start = text.find(needle)
+        if start < 0:
+            continue
+        pos = _skip_json_whitespace(text, start + len(needle))
+        if text[pos] != ":":
+            raise ValueError("expected ':' at offset {}".format(pos))
+        result[key] = _skip_json_whitespace(text, pos + 1)
+    return result
+
+
+def extract_json_fields(text: str, keys: 'Tuple[str, ...]') -> 'Dict[str, Any]':
+    """Decodes only the given top-level members of a JSON object."""
+    try:
+        return {
+            key: _json_decoder.raw_decode(text, pos)[0]
+            for key, pos in _json_member_offsets(text, keys).items()}
+    except IndexError:
+        raise ValueError("unexpected end of JSON document")
+
+
+def target_variants_file(build_folder: str) -> str:
+    return join(data_folder(build_folder), "target_variants.json")
+
+
+def save_target_variants(
+    build_folder: str,
+    variants: 'Dict[str, List[Dict[str, Any]]]'
+) -> None:
+    """Stores the build system variants of every configuration on disk."""
+    write_json_atomic(target_variants_file(build_folder), variants)
+
+
+def load_target_variants(
+    build_folder: str
+) -> 'Dict[str, List[Dict[str, Any]]]':
+    with open(target_variants_file(build_folder), "r") as fp:
         return json.load(fp)
 
 
+def executable_artifact(data: 'Dict[str, Any]') -> 'Optional[str]':
+    """Returns the path of the program built by an EXECUTABLE target."""
+    if data["type"] != "EXECUTABLE":
+        return None
+    name = data["name"]
+    name_on_disk = data["nameOnDisk"]
+    artifacts = [a["path"] for a in data["artifacts"]
+                 if a["path"].endswith(name_on_disk)]
+    if len(artifacts) == 0:
+        log("no suitable artifact for target", name)
+        return None
+    if len(artifacts) > 1:
+        log("too many candidate artifacts for target", name)
+        return None
+    return artifacts[0]
+
+
+def target_index_file(build_folder: str) -> str:
+    return join(data_folder(build_folder), "target_index.json")
+
+
+def save_target_index(
+    build_folder: str,
+    entries: 'Dict[str, List[Dict[str, Any]]]'
+) -> None:
+    write_json_atomic(target_index_file(build_folder), entries)
+
+
+class TargetIndex:
+    """A ranked search index over the targets of one configuration."""
+
+    def __init__(self, entries: 'List[Dict[str, Any]]') -> None:
+        self.entries = entries
+        self.__names = [e["name"].lower() for e in entries]
+        self.__haystacks = [
+            " ".join((e["name"], e["type"], e["directory"])).lower()
+            for e in entries]
+
+    def __score_word(self, word: str, enough: int,
+                     candidates: 'Optional[List[int]]' = None
+                     ) -> 'Dict[int, int]':
+        names = self.__names
+        haystacks = self.__haystacks
+        if candidates is None:
+            candidates = list(range(len(names)))
+        scores = {}  # type: Dict[int, int]
+        for i in [i for i in candidates if word in names[i]]:
+            name = names[i]
+            if name == word:
+                scores[i] = 0
+            elif name.startswith(word):
+                scores[i] = 1
+            else:
+                scores[i] = 2
+        if len(scores) >= enough:
+            # Nothing below can outrank what was found already.
+            return scores
+        for i in [i for i in candidates if word in haystacks[i]]:
+            scores.setdefault(i, 3)
+        # Written without lazy quantifiers, so that it never backtracks.
+        subsequence = re.compile("".join(
+            "[^{0}]*{0}".format(re.escape(c)) for c in word)).match
+        for i in [i for i in candidates if subsequence(names[i])]:
+            scores.setdefault(i, 4)
+        return scores
+
+    def search(self, query: str, limit: int = 100) -> 'List[Dict[str, Any]]':
+        """Returns the best matching entries, best first."""
+        words = query.lower().split()
+        if not words:
+            return self.entries[:limit]
+        everything = len(self.entries) + 1
+        total = self.__score_word(
+            words[0], limit if len(words) == 1 else everything)
+        for word in words[1:]:
+            scores = self.__score_word(word, everything, list(total))
+            total = {i: score + scores[i] for i, score in total.items()
+                     if i in scores}
+        names = self.__names
+        best = heapq.nsmallest(
+            limit, total, key=lambda i: (total[i], len(names[i]), i))
+        return [self.entries[i] for i in best]
+
+
+_target_indices = {}  # type: Dict[str, Tuple[int, Dict[str, TargetIndex]]]
+
+
+def load_target_index(build_folder: str) -> 'Dict[str, TargetIndex]':
+    """Returns the search index of every configuration of a build folder."""
+    path = target_index_file(build_folder)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _target_indices.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, "r") as fp:
+        data = json.load(fp)
+    indices = {config: TargetIndex(entries) for config, entries in data.items()}
+    _target_indices[path] = (mtime, indices)
+    return indices
+
+
+def load_target_summary(reply_folder: str, json_file: str) -> 'Dict[str, Any]':
+    with open(join(reply_folder, json_file), "r") as fp:
+        return extract_json_fields(fp.read(), TARGET_SUMMARY_KEYS)
+
+
+def source_index_file(build_folder: str) -> str:
+    return join(data_folder(build_folder), "source_index.json")
+
+
+def normalize_source_path(path: str) -> str:
+    return os.path.normcase(os.path.normpath(path))
+
+
+def target_sources_cache_file(build_folder: str) -> str:
+    return join(data_folder(build_folder), "target_sources.json")
+
+
+def load_target_sources(reply_folder: str, json_file: str) -> 'List[str]':
+    with open(join(reply_folder, json_file), "r") as fp:
+        reply = extract_json_fields(fp.read(), ("sources",))
+    return [source["path"] for source in reply.get("sources", [])]
+
+
+def save_source_index(
+    build_folder: str,
+    source_folder: str,
+    targets: 'Dict[str, str]'
+) -> None:
+    """Stores which targets each source file belongs to."""
+    source_folder = realpath(source_folder)
+    cache_file = target_sources_cache_file(build_folder)
+    try:
+        with open(cache_file, "r") as fp:
+            cache = json.load(fp)
+        cached = cache["targets"]  # type: Dict[str, List[str]]
+    except (OSError, ValueError, KeyError, TypeError):
+        cache = {}
+        cached = {}
+    missing = [f for f in targets if f not in cached]
+    log("reusing", len(targets) - len(missing), "source lists, reading",
+        len(missing))
+    path = source_index_file(build_folder)
+    if not missing and len(cached) == len(targets) and \
+            cache.get("source_folder") == source_folder and isfile(path):
+        return
+    target_sources = {f: cached[f] for f in targets if f in cached}
+    if missing:
+        reply_folder = file_api_reply(build_folder)
+        workers = min(32, (os.cpu_count() or 1) + 4, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for json_file, paths in zip(missing, pool.map(
+                    lambda f: load_target_sources(reply_folder, f), missing)):
+                target_sources[json_file] = paths
+    sources = {}  # type: Dict[str, List[str]]
+    for json_file, paths in target_sources.items():
+        name = targets[json_file]
+        for source in paths:
+            key = normalize_source_path(join(source_folder, source))
+            names = sources.setdefault(key, [])
+            if name not in names:
+                names.append(name)
+    for names in sources.values():
+        names.sort()
+    if write_json_atomic(path, {"sources": sources}):
+        write_json_atomic(cache_file, {"source_folder": source_folder,
+                                       "targets": target_sources})
+
+
+_source_indices = {}  # type: Dict[str, Tuple[int, Dict[str, List[str]]]]
+
+
+def find_targets_of_source(build_folder: str, file_name: str) -> 'List[str]':
+    """Returns the names of the targets that compile the given file."""
+    path = source_index_file(build_folder)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _source_indices.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r") as fp:
+            cached = (mtime, json.load(fp)["sources"])
+        _source_indices[path] = cached
+    return cached[1].get(normalize_source_path(realpath(file_name)), [])
+
+
+def load_cmake_cache(build_folder: str) -> 'Dict[str, str]':
+    """Reads the variables of CMakeCache.txt, without their types."""
+    result = {}  # type: Dict[str, str]
+    with open(join(build_folder, "CMakeCache.txt"), "r") as fp:
+        for line in fp:
+            if line.startswith(("#", "//")) or "=" not in line:
+                continue
+            key, value = line.rstrip("\n").split("=", 1)
+            result[key.split(":", 1)[0]] = value
+    return result
+
+
+def is_msvc_compiler(compiler: str) -> bool:
+    name = os.path.basename(compiler).lower()
+    return name in ("cl", "cl.exe", "clang-cl", "clang-cl.exe")
+
+
+def quote_argument(arg: str) -> str:
+    if sublime.platform() == "windows":
+        return subprocess.list2cmdline([arg])
+    return shlex.quote(arg)
+
+
+def compile_command(
+    compiler: str,
+    compile_group: 'Dict[str, Any]',
+    source: str,
+    output: 'Optional[str]' = None
+) -> str:
+    """Builds the shell command that compiles a single source file."""
+    msvc = is_msvc_compiler(compiler)
+    args = [quote_argument(compiler)]
+    for fragment in compile_group.get("compileCommandFragments", []):
+        args.append(fragment["fragment"])
+    sysroot = compile_group.get("sysroot")
+    if sysroot and not msvc:
+        args.append(quote_argument("--sysroot=" + sysroot["path"]))
+    for define in compile_group.get("defines", []):
+        args.append(quote_argument(("/D" if msvc else "-D") + define["define"]))
+    for include in compile_group.get("includes", []):
+        if include.get("isSystem") and not msvc:
+            args.extend(["-isystem", quote_argument(include["path"])])
+        else:
+            flag = "/I" if msvc else "-I"
+            args.append(quote_argument(flag + include["path"]))
+    for framework in compile_group.get("frameworks", []):
+        flag = "-iframework" if framework.get("isSystem") else "-F"
+        args.extend([flag, quote_argument(framework["path"])])
+    if msvc:
+        args.extend(["/c", quote_argument(source)])
+        if output:
+            args.append(quote_argument("/Fo" + output))
+    else:
+        args.extend(["-c", quote_argument(source)])
+        if output:
+            args.extend(["-o", quote_argument(output)])
+    return " ".join(args)
+
+
+def find_compile_group(
+    reply: 'Dict[str, Any]',
+    source_folder: str,
+    file_name: str
+) -> 'Optional[Dict[str, Any]]':
+    """Returns the compile group of a file in a target reply."""
+    source_folder = realpath(source_folder)
+    path = normalize_source_path(realpath(file_name))
+    for source in reply.get("sources", []):
+        if normalize_source_path(join(source_folder, source["path"])) != path:
+            continue
+        if "compileGroupIndex" not in source:
+            return None
+        return reply["compileGroups"][source["compileGroupIndex"]]
+    return None
+
+
+def compile_commands_fragments_folder(build_folder: str) -> str:
+    return join(data_folder(build_folder), "compile_commands")
+
+
+def write_compile_commands_fragment(
+    folder: str,
+    reply_folder: str,
+    json_file: str,
+    build_folder: str,
+    source_folder: str,
+    compilers: 'Dict[str, str]'
+) -> None:
+    """Writes the compile_commands.json entries of one target to a file."""
+    with open(join(reply_folder, json_file), "r") as fp:
+        reply = extract_json_fields(fp.read(), ("compileGroups", "sources"))
+    groups = reply.get("compileGroups", [])
+    entries = []  # type: List[str]
+    for source in reply.get("sources", []):
+        if "compileGroupIndex" not in source:
+            continue
+        group = groups[source["compileGroupIndex"]]
+        compiler = compilers.get(group.get("language", ""))
+        if not compiler:
+            continue
+        path = join(source_folder, source["path"])
+        entries.append(json.dumps({
+            "directory": build_folder,
+            "command": compile_command(compiler, group, path),
+            "file": path}))
+    tmp = join(folder, json_file + ".tmp")
+    with open(tmp, "w") as fp:
+        fp.write(",\n".join(entries))
+    os.replace(tmp, join(folder, json_file))
+
+
+def write_compile_commands(
+    build_folder: str,
+    source_folder: str,
+    json_files: 'List[str]'
+) -> None:
+    """Writes compile_commands.json from the compile groups of the targets."""
+    folder = compile_commands_fragments_folder(build_folder)
+    makedirs(folder, exist_ok=True)
+    compilers = get_compilers(build_folder)
+    compilers_file = join(folder, "compilers.json")
+    try:
+        with open(compilers_file, "r") as fp:
+            previous_compilers = json.load(fp)
+    except (OSError, ValueError):
+        previous_compilers = None
+    existing = set(os.listdir(folder))
+    existing.discard("compilers.json")
+    if previous_compilers != compilers:
+        # Every fragment mentions the compiler, so none can be reused.
+        for name in existing:
+            os.remove(join(folder, name))
+        existing.clear()
+        write_json_atomic(compilers_file, compilers)
+    for name in existing.difference(json_files):
+        os.remove(join(folder, name))
+    missing = [f for f in dict.fromkeys(json_files) if f not in existing]
+    log("computing compile commands of", len(missing), "targets")
+    if missing:
+        reply_folder = file_api_reply(build_folder)
+        workers = min(32, (os.cpu_count() or 1) + 4, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(write_compile_commands_fragment,
+                                       folder, reply_folder, f, build_folder,
+                                       source_folder, compilers)
+                           for f in missing]:
+                future.result()
+    path = join(build_folder, "compile_commands.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as out:
+        out.write("[\n")
+        first = True
+        for json_file in dict.fromkeys(json_files):
+            with open(join(folder, json_file), "r") as fp:
+                fragment = fp.read()
+            if not fragment:
+                continue
+            if not first:
+                out.write(",\n")
+            out.write(fragment)
+            first = False
+        out.write("\n]\n")
+    os.replace(tmp, path)
+
+
+def load_target_summaries(
+    reply_folder: str,
+    json_files: 'List[str]',
+    on_progress: 'Optional[Callable[[int, int], None]]' = None,
+    cached: 'Optional[Dict[str, Dict[str, Any]]]' = None
+) -> 'Dict[str, Dict[str, Any]]':
+    """Reads the summaries of target replies on a pool of worker threads."""
+    result = {}  # type: Dict[str, Dict[str, Any]]
+    unique = []  # type: List[str]
+    for json_file in dict.fromkeys(json_files):
+        if cached and json_file in cached:
+            result[json_file] = cached[json_file]
+        else:
+            unique.append(json_file)
+    log("reusing", len(result), "target summaries, parsing", len(unique))
+    total = len(unique)
+    if not total:
+        return result
+    workers = min(32, (os.cpu_count() or 1) + 4, total)
+    step = max(1, total // 50)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(load_target_summary, reply_folder, f): f
+                   for f in unique}
+        for done, future in enumerate(as_completed(futures), 1):
+            result[futures[future]] = future.result()
+            if on_progress and (done % step == 0 or done == total):
+                on_progress(done, total)
+    return result
+
+
 def get_setting_value(
     the_dict: 'Dict[str, Any]',
     key: str,
@@ -305,59 +1741,592 @@ def get_setting_value(
         return default
 
 
-def get_setting(view: Optional[sublime.View], key, default=None) -> Union[bool, str]:
-    if view:
-        view_settings = view.settings()
-        if view_settings.has('CMakeBuilder'):
-            settings = view_settings['CMakeBuilder']
-            val = get_setting_value(settings, key, None)
-            if val is not None:
-                return val
+def get_setting(view: Optional[sublime.View], key, default=None) -> Union[bool, str]:
+    if view:
+        view_settings = view.settings()
+        if view_settings.has('CMakeBuilder'):
+            settings = view_settings['CMakeBuilder']
+            val = get_setting_value(settings, key, None)
+            if val is not None:
+                return val
+
+    settings = sublime.load_settings('CMakeBuilder.sublime-settings')
+    return get_setting_value(settings, key, default)
+
+
+def get_cmake_binary(view: Optional[sublime.View]) -> str:
+    return str(get_setting(view, "cmake_binary", "cmake"))
+
+
+def log(*args) -> None:
+    if get_setting(None, "cmake_debug", False):
+        print("CMakeBuilder:", *args)
+
+
+class CmakeSettings:
+    """An immutable snapshot of the CMakeBuilder settings for a window."""
+
+    # attribute name -> (setting key, default value)
+    KEYS = {
+        "cmake_binary": ("cmake_binary", "cmake"),
+        "ctest_binary": ("ctest_binary", "ctest"),
+        "build_parallel_jobs": ("build_parallel_jobs", None),
+        "ctest_parallel_jobs": ("ctest_parallel_jobs", None),
+        "ctest_command_line_args": ("ctest_command_line_args", ""),
+        "build_folder": ("build_folder", "$folder/build"),
+        "root_folder": ("root_folder", "$folder"),
+        "overrides": ("command_line_overrides", {}),
+        "generator": ("generator", None),
+        "platform": ("generator_platform", None),
+        "toolset": ("generator_toolset", {}),
+        "vs_major_version": ("generator_vs_major_version", None),
+        "env": ("env", {}),
+        "silence_developer_warnings": ("silence_developer_warnings", False),
+        "always_clear_cache_before_configure": (
+            "always_clear_cache_before_configure", False),
+        "terminus_use_panel": ("terminus_use_panel", False),
+        "terminus_auto_close": ("terminus_auto_close", False),
+        "compact_build_systems": ("compact_build_systems", False),
+        "generate_compile_commands": ("generate_compile_commands", False),
+        "reconfigure_on_save": ("reconfigure_on_save", False),
+        "filter_build_output": ("filter_build_output", False),
+        "build_regression_threshold": ("build_regression_threshold", 25),
+    }  # type: Dict[str, Tuple[str, Any]]
+
+    __slots__ = tuple(KEYS) + ("unexpanded_build_folder",)
+
+    cmake_binary: str
+    ctest_binary: str
+    build_parallel_jobs: 'Union[None, int, str]'
+    ctest_parallel_jobs: 'Union[None, int, str]'
+    ctest_command_line_args: str
+    build_folder: str
+    root_folder: str
+    overrides: 'Dict[str, str]'
+    generator: 'Optional[str]'
+    platform: 'Optional[str]'
+    toolset: 'Dict[str, str]'
+    vs_major_version: 'Optional[int]'
+    env: 'Dict[str, str]'
+    silence_developer_warnings: bool
+    always_clear_cache_before_configure: bool
+    terminus_use_panel: bool
+    terminus_auto_close: bool
+    compact_build_systems: bool
+    generate_compile_commands: bool
+    reconfigure_on_save: bool
+    filter_build_output: bool
+    build_regression_threshold: float
+    unexpanded_build_folder: str
+
+    def __init__(self, window: sublime.Window) -> None:
+        view = window.active_view()
+        view_settings = {}  # type: Dict[str, Any]
+        if view:
+            settings = view.settings()
+            if settings.has("CMakeBuilder"):
+                view_settings = settings.get("CMakeBuilder")
+        package_settings = sublime.load_settings("CMakeBuilder.sublime-settings")
+        raw = {}  # type: Dict[str, Any]
+        for attr, (key, default) in self.KEYS.items():
+            val = get_setting_value(view_settings, key, None)
+            if val is None:
+                val = get_setting_value(package_settings, key, default)
+            raw[attr] = val
+        expanded = sublime.expand_variables(raw, window.extract_variables())
+        expanded["root_folder"] = realpath(expanded["root_folder"])
+        expanded["unexpanded_build_folder"] = raw["build_folder"]
+        for attr, val in expanded.items():
+            object.__setattr__(self, attr, val)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("CmakeSettings is immutable")
+
+
+def syntax(name: str) -> str:
+    return "Packages/CMakeBuilder/Syntax/{}.sublime-syntax".format(name)
+
+
+def build_history_file(build_folder: str) -> str:
+    # Not in the data folder, so that clearing the cache keeps the history.
+    return join(build_folder, ".cmakebuilder_history")
+
+
+class BuildRecord:
+    """Appends one line per finished build to the build history."""
+
+    def __init__(self, build_folder: str, config: str,
+                 build_target: 'Union[None, str, List[str]]') -> None:
+        if isinstance(build_target, list):
+            build_target = ",".join(build_target)
+        self.build_folder = build_folder
+        self.config = config
+        self.target = build_target or "all"
+        self.started = time.time()
+
+    def finish(self, exit_code: 'Optional[int]') -> None:
+        line = "{:.0f}\t{}\t{}\t{}\t{:.2f}\n".format(
+            self.started, self.config, self.target,
+            -1 if exit_code is None else exit_code,
+            time.time() - self.started)
+        try:
+            with open(build_history_file(self.build_folder), "a") as fp:
+                fp.write(line)
+        except OSError as e:
+            log("unable to record the build:", e)
+
+
+def load_build_history(
+    build_folder: str
+) -> 'Dict[Tuple[str, str], List[Tuple[float, int, float]]]':
+    """Returns (started, exit code, seconds) per (config, target)."""
+    history = {}  # type: Dict[Tuple[str, str], List[Tuple[float, int, float]]]
+    try:
+        with open(build_history_file(build_folder), "r") as fp:
+            for line in fp:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 5:
+                    continue
+                try:
+                    entry = (float(fields[0]), int(fields[3]),
+                             float(fields[4]))
+                except ValueError:
+                    continue
+                history.setdefault((fields[1], fields[2]), []).append(entry)
+    except FileNotFoundError:
+        pass
+    return history
+
+
+def find_regressions(
+    builds: 'List[Tuple[float, int, float]]',
+    threshold: float,
+    window: int = 10
+) -> 'List[Tuple[float, float, float]]':
+    """Returns (started, seconds, median) of the builds slower than usual."""
+    result = []  # type: List[Tuple[float, float, float]]
+    previous = []  # type: List[float]
+    for started, exit_code, seconds in builds:
+        if exit_code != 0:
+            continue
+        if len(previous) >= 3:
+            median = statistics.median(previous[-window:])
+            if seconds > median * (1 + threshold / 100):
+                result.append((started, seconds, median))
+        previous.append(seconds)
+    return result
+
+
+def history_minihtml(
+    history: 'Dict[Tuple[str, str], List[Tuple[float, int, float]]]',
+    threshold: float
+) -> str:
+    result = ["<h1>Build History</h1>"]
+    for (config, target), builds in sorted(history.items()):
+        ok = [seconds for _, exit_code, seconds in builds if exit_code == 0]
+        result.extend(["<h2>", escape(target), " (", escape(config),
+                       ")</h2><ul>"])
+        result.extend(["<li>", "Builds: {}, failed: {}".format(
+            len(builds), len(builds) - len(ok)), "</li>"])
+        if ok:
+            result.extend([
+                "<li>", "Last: {:.1f} s, median: {:.1f} s".format(
+                    ok[-1], statistics.median(ok[-10:])), "</li>",
+                "<li>", "Recent: ", ", ".join(
+                    "{:.1f}".format(x) for x in ok[-10:]), "</li>"])
+        for started, seconds, median in find_regressions(builds, threshold):
+            result.extend([
+                "<li>", "Slower than usual: {} took {:.1f} s, "
+                "{:.0f}% above the median of {:.1f} s".format(
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(started)),
+                    seconds, 100 * (seconds / median - 1), median), "</li>"])
+        result.append("</ul>")
+    return "".join(result)
+
+
+class CmakeBuildHistoryCommand(sublime_plugin.WindowCommand):
+    """Shows how long builds took and which ones were unusually slow."""
+
+    def is_enabled(self) -> bool:
+        return project_roots.is_cmake_project(self.window)
+
+    @classmethod
+    def description(cls):
+        return "Build History"
+
+    def run(self) -> None:
+        info = project_roots.load_info(self.window)
+        if info is None:
+            return
+        history = load_build_history(info.build_folder)
+        if not history:
+            self.window.status_message("No builds recorded yet")
+            return
+        self.window.new_html_sheet(
+            "CMakeBuilder Build History",
+            history_minihtml(
+                history, info.settings.build_regression_threshold))
+
+
+class CmakeBuildCommand(ExecCommand):
+
+    def run(
+        self,
+        working_dir: str = "",
+        config: str = "",
+        env: 'Optional[Dict[str, str]]' = None,
+        build_target: 'Union[None, str, List[str]]' = None,
+        generator: 'Optional[str]' = None,
+        kill=False
+    ) -> None:
+        if kill:
+            # Killing leaves the state of the running build alone.
+            super().run(kill=True)
+            return
+        settings = CmakeSettings(self.window)
+        gen = make_generator(working_dir, generator)
+        cmd = [settings.cmake_binary, "--build", ".", "--config", config]
+        jobs = build_jobs(settings.build_parallel_jobs, gen)
+        if jobs:
+            cmd.extend(["--parallel", str(jobs)])
+        if isinstance(build_target, str):
+            cmd.extend(["--target", build_target])
+        elif build_target:
+            cmd.append("--target")
+            cmd.extend(build_target)
+        if settings.filter_build_output:
+            self.__filter = BuildOutputFilter(
+                gen.pattern())  # type: Optional[BuildOutputFilter]
+        else:
+            self.__filter = None
+        self.__pending = []  # type: List[str]
+        self.__pending_lock = threading.Lock()
+        self.__flush_scheduled = False
+        self.__index = DiagnosticIndex(gen.pattern(), working_dir)
+        _diagnostics[self.window.id()] = self.__index
+        self.__record = BuildRecord(
+            working_dir, config,
+            build_target)  # type: Optional[BuildRecord]
+        mark_all_diagnostics(self.window)
+        if isinstance(gen, NinjaGenerator):
+            mark_ninja_build_start(working_dir)
+        # F4, double-clicking a result and the inline annotations need the
+        # file_regex; cmake_next_error and the gutter marks do not.
+        super().run(
+            cmd=cmd,
+            working_dir=working_dir,
+            env=env,
+            syntax=gen.syntax(),
+            file_regex=gen.regex())
+
+    def on_data(self, proc, data: str) -> None:
+        if proc is not self.proc:
+            # Output of a previous build that is still running.
+            super().on_data(proc, data)
+            return
+        build_filter = self.__filter
+        if build_filter is None:
+            self.__index.feed(data)
+            super().on_data(proc, data)
+            return
+        # Called on the reader thread; appends to the panel are batched.
+        with self.__pending_lock:
+            text = build_filter.feed(data)
+            if text:
+                self.__pending.append(text)
+            if self.__flush_scheduled:
+                return
+            self.__flush_scheduled = True
+        sublime.set_timeout(lambda: self.__flush(proc), 100)
+
+    def __flush(self, proc) -> None:
+        if proc is not self.proc:
+            # A new build started; the pending text is its own.
+            return
+        build_filter = self.__filter
+        with self.__pending_lock:
+            text = "".join(self.__pending)
+            self.__pending = []
+            self.__flush_scheduled = False
+        if build_filter is None:
+            return
+        if text:
+            self.__index.feed(text)
+            super().on_data(proc, text)
+        if build_filter.progress:
+            self.window.status_message(
+                "Building [{}]".format(build_filter.progress))
+
+    def on_finished(self, proc) -> None:
+        if proc is not self.proc:
+            super().on_finished(proc)
+            return
+        build_filter = self.__filter
+        if build_filter is not None:
+            with self.__pending_lock:
+                self.__pending.append(build_filter.flush())
+            self.__flush(proc)
+            if build_filter.hidden:
+                super().on_data(proc, "[{} lines of build output hidden]\n"
+                                .format(build_filter.hidden))
+            self.__filter = None
+        self.__index.flush()
+        record = self.__record
+        self.__record = None
+        if record and not getattr(proc, "killed", False):
+            record.finish(proc.exit_code())
+        super().on_finished(proc)
+        sublime.set_timeout(lambda: mark_all_diagnostics(self.window), 0)
+
+
+class CmakePickTargetCommand(sublime_plugin.WindowCommand):
+    """Lets the user pick a target variant of a compact build system."""
+
+    def run(
+        self,
+        working_dir: str = "",
+        config: str = "",
+        env: 'Optional[Dict[str, str]]' = None,
+        generator: 'Optional[str]' = None,
+        kill=False
+    ) -> None:
+        if kill:
+            self.window.run_command("cmake_build", {"kill": True})
+            return
+        try:
+            variants = load_target_variants(working_dir)[config]
+        except (OSError, ValueError, KeyError):
+            sublime.error_message(
+                "No targets found for configuration {}. "
+                "Please run CMakeBuilder: Configure.".format(config))
+            return
+        base = {"working_dir": working_dir, "config": config, "env": env}
+        if generator:
+            base["generator"] = generator
+
+        def on_done(index: int) -> None:
+            if index < 0:
+                return
+            variant = dict(variants[index])
+            del variant["name"]
+            command = variant.pop("target", "cmake_build")
+            args = dict(base)
+            args.update(variant)
+            self.window.run_command(command, args)
+
+        self.window.show_quick_panel([v["name"] for v in variants], on_done)
+
+
+def choose_configuration(
+    window: sublime.Window,
+    configs: 'List[str]',
+    config: 'Optional[str]',
+    on_done: 'Callable[[str], None]'
+) -> None:
+    """Calls on_done with `config`, or asks the user to pick one."""
+    if config is not None:
+        on_done(config)
+    elif len(configs) == 1:
+        on_done(configs[0])
+    elif configs:
+        window.show_quick_panel(
+            configs, lambda i: on_done(configs[i]) if i >= 0 else None)
+
+
+class CmakeBuildFileTargetsCommand(sublime_plugin.WindowCommand):
+    """Builds only the targets that compile the file in the active view."""
+
+    def is_enabled(self) -> bool:
+        view = self.window.active_view()
+        return bool(view and view.file_name()) and \
+            project_roots.is_cmake_project(self.window)
+
+    @classmethod
+    def description(cls):
+        return "Build Targets of Current File"
+
+    def run(self, config: 'Optional[str]' = None) -> None:
+        view = self.window.active_view()
+        file_name = view.file_name() if view else None
+        info = project_roots.load_info(self.window)
+        if not file_name or info is None:
+            return
+        try:
+            targets = find_targets_of_source(info.build_folder, file_name)
+            configs = sorted(load_target_index(info.build_folder))
+        except (OSError, ValueError):
+            sublime.error_message(
+                "No targets found. Please run CMakeBuilder: Configure.")
+            return
+        if not targets:
+            self.window.status_message(
+                "No target contains {}".format(os.path.basename(file_name)))
+            return
+
+        def on_config(config: str) -> None:
+            assert info
+            self.window.run_command("cmake_build", {
+                "working_dir": info.build_folder,
+                "config": config,
+                "env": info.env,
+                "generator": info.generator,
+                "build_target": targets})
+
+        choose_configuration(self.window, configs, config, on_config)
+
+
+class CmakeCompileFileCommand(ExecCommand):
+    """Compiles only the file in the active view."""
 
-    settings = sublime.load_settings('CMakeBuilder.sublime-settings')
-    return get_setting_value(settings, key, default)
+    def is_enabled(self, config: 'Optional[str]' = None, kill=False) -> bool:
+        if kill:
+            return True
+        view = self.window.active_view()
+        return bool(view and view.file_name()) and \
+            project_roots.is_cmake_project(self.window)
 
+    @classmethod
+    def description(cls):
+        return "Compile Current File"
 
-def get_cmake_binary(view: Optional[sublime.View]) -> str:
-    return str(get_setting(view, "cmake_binary", "cmake"))
+    def run(self, config: 'Optional[str]' = None, kill=False) -> None:
+        if kill:
+            super().run(kill=True)
+            return
+        view = self.window.active_view()
+        file_name = view.file_name() if view else None
+        info = project_roots.load_info(self.window)
+        if not file_name or info is None:
+            return
+        try:
+            targets = find_targets_of_source(info.build_folder, file_name)
+            indices = load_target_index(info.build_folder)
+        except (OSError, ValueError):
+            sublime.error_message(
+                "No targets found. Please run CMakeBuilder: Configure.")
+            return
+        if not targets:
+            self.window.status_message(
+                "No target contains {}".format(os.path.basename(file_name)))
+            return
 
+        def on_config(config: str) -> None:
+            assert info and file_name
+            entries = indices[config].entries
+            json_file = next((e.get("jsonFile") for e in entries
+                              if e["name"] in targets), None)
+            if not json_file:
+                sublime.error_message(
+                    "No target found. Please run CMakeBuilder: Configure.")
+                return
+            self.__compile(info, file_name, json_file)
 
-def get_ctest_binary(view: Optional[sublime.View]) -> str:
-    return str(get_setting(view, "ctest_binary", "ctest"))
+        choose_configuration(self.window, sorted(indices), config, on_config)
 
+    def __compile(self, info: 'CmakeInfo', file_name: str,
+                  json_file: str) -> None:
+        build_folder = info.build_folder
+        with open(join(file_api_reply(build_folder), json_file), "r") as fp:
+            reply = extract_json_fields(fp.read(),
+                                        ("compileGroups", "sources"))
+        try:
+            codemodel = load_reply_model(build_folder).codemodel
+        except (OSError, ValueError, IndexError):
+            codemodel = None
+        if codemodel is None:
+            sublime.error_message(
+                "No codemodel found. Please run CMakeBuilder: Configure.")
+            return
+        group = find_compile_group(reply, codemodel.source_folder, file_name)
+        if group is None:
+            self.window.status_message(
+                "{} is not compiled by itself".format(
+                    os.path.basename(file_name)))
+            return
+        compiler = get_compilers(build_folder).get(group["language"])
+        if not compiler:
+            sublime.error_message(
+                "No compiler found for {}".format(group["language"]))
+            return
+        output = join(data_folder(build_folder), "compile_file")
+        output += ".obj" if is_msvc_compiler(compiler) else ".o"
+        makedirs(data_folder(build_folder), exist_ok=True)
+        gen = make_generator(build_folder, info.generator)
+        super().run(
+            shell_cmd=compile_command(compiler, group, file_name, output),
+            working_dir=build_folder,
+            env=info.env,
+            syntax=gen.syntax(),
+            file_regex=gen.regex())
 
-def log(*args) -> None:
-    if get_setting(None, "cmake_debug", False):
-        print("CMakeBuilder:", *args)
 
+class CmakeSelectTargetCommand(sublime_plugin.WindowCommand):
+    """Searches the targets of the project and builds or runs one of them."""
 
-def syntax(name: str) -> str:
-    return "Packages/CMakeBuilder/Syntax/{}.sublime-syntax".format(name)
+    def is_enabled(self) -> bool:
+        return project_roots.is_cmake_project(self.window)
 
+    @classmethod
+    def description(cls):
+        return "Select Target..."
 
-class CmakeBuildCommand(ExecCommand):
+    def run(self, config: 'Optional[str]' = None, query: str = "") -> None:
+        self.info = project_roots.load_info(self.window)
+        if self.info is None:
+            return
+        try:
+            self.indices = load_target_index(self.info.build_folder)
+        except (OSError, ValueError):
+            sublime.error_message(
+                "No targets found. Please run CMakeBuilder: Configure.")
+            return
+        choose_configuration(self.window, sorted(self.indices), config,
+                             lambda c: self.on_config(c, query))
 
-    def run(
-        self,
-        working_dir: str,
-        config: str,
-        env: 'Dict[str, str]',
-        build_target: 'Optional[str]' = None,
-        generator: 'Optional[str]' = None,
-        kill=False
-    ) -> None:
-        gen = make_generator(working_dir, generator)
-        cmd = [get_cmake_binary(self.window.active_view()),
-               "--build", ".", "--config", config]
-        if build_target:
-            cmd.extend(["--target", build_target])
-        super().run(
-            cmd=cmd,
-            working_dir=working_dir,
-            env=env,
-            syntax=gen.syntax(),
-            file_regex=gen.regex(),
-            kill=kill)
+    def on_config(self, config: str, query: str) -> None:
+        index = self.indices.get(config)
+        if index is None:
+            sublime.error_message("Unknown configuration: {}".format(config))
+            return
+        self.config = config
+        self.index = index
+        self.window.show_input_panel(
+            "Target ({}): ".format(config), query, self.on_query,
+            self.on_change, None)
+
+    def on_change(self, query: str) -> None:
+        matches = self.index.search(query, 1)
+        if matches:
+            self.window.status_message("Best match: " + matches[0]["name"])
+
+    def on_query(self, query: str) -> None:
+        choices = []  # type: List[Tuple[str, Dict[str, Any]]]
+        for entry in self.index.search(query):
+            choices.append(("Build: " + entry["name"], entry))
+            if "artifact" in entry:
+                choices.append(("Run: " + entry["name"], entry))
+        if not choices:
+            self.window.status_message("No target matches " + query)
+            return
+        items = [[caption, "{}  {}".format(entry["type"], entry["directory"])]
+                 for caption, entry in choices]
+        self.window.show_quick_panel(
+            items, lambda i: self.on_select(choices[i]) if i >= 0 else None)
+
+    def on_select(self, choice: 'Tuple[str, Dict[str, Any]]') -> None:
+        assert self.info
+        caption, entry = choice
+        args = {
+            "working_dir": self.info.build_folder,
+            "config": self.config,
+            "env": self.info.env,
+            "generator": self.info.generator,
+            "build_target": entry["name"]}
+        if caption.startswith("Run: "):
+            args["artifact"] = entry["artifact"]
+            self.window.run_command("cmake_run", args)
+        else:
+            self.window.run_command("cmake_build", args)
 
 
 cached_command_line_args = ""
@@ -403,10 +2372,18 @@ class CmakeRunCommand(sublime_plugin.WindowCommand):
                 debugger = ["gdb", "-q", "--args"] if self.debug else []
             else:  # osx
                 debugger = ["lldb", "--"] if self.debug else []
-        view = self.window.active_view()
-        cmd = [get_cmake_binary(self.window.active_view()),
-               "--build", ".", "--config", self.config,
-               "--target", self.build_target, conjunction]
+        settings = CmakeSettings(self.window)
+        cmd = [settings.cmake_binary, "--build", ".", "--config", self.config]
+        if settings.build_parallel_jobs is not None:
+            try:
+                gen = make_generator(self.working_dir, self.generator)
+            except (KeyError, IndexError, OSError, ValueError):
+                # An unknown generator, or not configured yet.
+                gen = Generator()
+            jobs = build_jobs(settings.build_parallel_jobs, gen)
+            if jobs:
+                cmd.extend(["--parallel", str(jobs)])
+        cmd.extend(["--target", self.build_target, conjunction])
         cmd.extend(debugger)
         cmd.append(executable)
         cmd.extend(shlex.split(command_line_args, posix=posix))
@@ -416,8 +2393,8 @@ class CmakeRunCommand(sublime_plugin.WindowCommand):
             "env": self.env,
             "cmd": cmd,
             "cwd": self.working_dir,
-            "auto_close": get_setting(view, "terminus_auto_close", False)}
-        if get_setting(view, "terminus_use_panel", False):
+            "auto_close": settings.terminus_auto_close}
+        if settings.terminus_use_panel:
             args["panel_name"] = self.build_target
         self.window.run_command("terminus_open", args)
 
@@ -451,76 +2428,301 @@ class CtestRunCommand(ExecCommand):
         config: str,
         generator: 'Optional[str]' = None,
     ) -> None:
-        extra_args = get_setting(self.window.active_view(),
-                                 "ctest_command_line_args", "")
+        settings = CmakeSettings(self.window)
+        extra_args = settings.ctest_command_line_args
+        cmd = [settings.ctest_binary, "-C", config]
+        jobs = test_jobs(settings.ctest_parallel_jobs)
+        if jobs:
+            cmd.extend(["-j", str(jobs)])
         super().run(
-            cmd=[get_ctest_binary(self.window.active_view()), "-C", config] + [str(extra_args)],
+            cmd=cmd + [str(extra_args)],
             working_dir=working_dir,
             env=env,
             syntax=syntax("CTest"))
 
 
+def test_results_folder(build_folder: str) -> str:
+    return join(data_folder(build_folder), "ctest")
+
+
+def list_tests(ctest_binary: str, config: str, env: 'Dict[str, str]',
+               build_folder: str) -> 'List[str]':
+    """Returns the names of the tests, in the order that -I refers to."""
+    output = check_output(
+        "{} -C {} --show-only=json-v1".format(
+            quote_argument(ctest_binary), quote_argument(config)),
+        env=env, cwd=build_folder)
+    return [test["name"] for test in json.loads(output).get("tests", [])]
+
+
+def parse_junit(path: str) -> 'Dict[str, Dict[str, Any]]':
+    """Returns status, time and output of every test case in a JUnit file."""
+    result = {}  # type: Dict[str, Dict[str, Any]]
+    for case in ElementTree.parse(path).getroot().iter("testcase"):
+        if case.find("failure") is not None:
+            status = "failed"
+        elif case.get("status") in ("notrun", "disabled") or \
+                case.find("skipped") is not None:
+            status = "skipped"
+        else:
+            status = "passed"
+        result[case.get("name", "")] = {
+            "status": status,
+            "time": float(case.get("time") or 0),
+            "output": case.findtext("system-out") or "",
+        }
+    return result
+
+
+def shard_arguments(indices: 'Optional[List[int]]', total: int, shard: int,
+                    shards: int) -> 'List[str]':
+    """Returns the -I argument that selects the tests of one shard."""
+    if indices is None:
+        return ["-I", "{},{},{}".format(shard + 1, total, shards)]
+    return ["-I", "0,0,0," + ",".join(str(i) for i in indices[shard::shards])]
+
+
+def run_tests(
+    ctest_binary: str,
+    config: str,
+    env: 'Dict[str, str]',
+    build_folder: str,
+    names: 'List[str]',
+    indices: 'Optional[List[int]]',
+    jobs: int,
+    on_progress: 'Callable[[int, int], None]'
+) -> 'List[Dict[str, Any]]':
+    """Runs the given tests in parallel ctest processes."""
+    count = len(names) if indices is None else len(indices)
+    shards = max(1, min(jobs, count))
+    folder = test_results_folder(build_folder)
+    makedirs(folder, exist_ok=True)
+    startupinfo = None
+    if os.name == "nt":
+        startupinfo = subprocess.STARTUPINFO()  # type: ignore
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW  # type: ignore
+    procs = []
+    for shard in range(shards):
+        junit = join(folder, "shard-{}.xml".format(shard))
+        if isfile(junit):
+            os.remove(junit)
+        cmd = [ctest_binary, "-C", config, "--output-junit", junit]
+        cmd.extend(shard_arguments(indices, len(names), shard, shards))
+        with open(join(folder, "shard-{}.log".format(shard)), "wb") as out:
+            procs.append((junit, subprocess.Popen(
+                cmd, cwd=build_folder, env=env, stdout=out,
+                stderr=subprocess.STDOUT, startupinfo=startupinfo)))
+    cases = {}  # type: Dict[str, Dict[str, Any]]
+    for done, (junit, proc) in enumerate(procs, 1):
+        proc.wait()
+        try:
+            cases.update(parse_junit(junit))
+        except (OSError, ElementTree.ParseError) as e:
+            log("unable to read", junit, e)
+        on_progress(done, shards)
+    selected = range(1, len(names) + 1) if indices is None else indices
+    results = []  # type: List[Dict[str, Any]]
+    for index in selected:
+        name = names[index - 1]
+        case = cases.get(name) or {
+            "status": "failed", "time": 0.0,
+            "output": "No result; ctest may have crashed."}
+        case["index"] = index
+        case["name"] = name
+        results.append(case)
+    return results
+
+
+def test_results_minihtml(results: 'List[Dict[str, Any]]', wall: float) -> str:
+    groups = {
+        "failed": [], "skipped": [], "passed": []
+    }  # type: Dict[str, List[Dict[str, Any]]]
+    for r in results:
+        groups[r["status"]].append(r)
+    result = [
+        "<h1>Test Results</h1><p>",
+        "{} passed, {} failed, {} skipped. ".format(
+            len(groups["passed"]), len(groups["failed"]),
+            len(groups["skipped"])),
+        "Test time {:.1f} s, wall time {:.1f} s.".format(
+            sum(r["time"] for r in results), wall),
+        "</p>"]
+    if groups["failed"]:
+        result.append("<p><a href='subl:cmake_run_tests "
+                      "{\"rerun_failed\": true}'>Rerun failed tests</a></p>")
+    for status in ("failed", "skipped", "passed"):
+        if not groups[status]:
+            continue
+        result.extend(["<h2>", status.capitalize(), "</h2><ul>"])
+        for r in sorted(groups[status], key=lambda r: -r["time"]):
+            result.extend(["<li>", escape(r["name"]),
+                           " ({:.2f} s)".format(r["time"])])
+            if status == "failed" and r["output"]:
+                lines = r["output"].rstrip().splitlines()[-20:]
+                result.extend(["<div class='output'>",
+                               "<br>".join(escape(line) for line in lines),
+                               "</div>"])
+            result.append("</li>")
+        result.append("</ul>")
+    return "".join(result)
+
+
+# window id -> (config, names of the failed tests) of the last test run
+_failed_tests = {}  # type: Dict[int, Tuple[str, List[str]]]
+
+
+class CmakeRunTestsCommand(sublime_plugin.WindowCommand):
+    """Runs the tests of the project and shows the results in a sheet."""
+
+    def is_enabled(self, config=None, rerun_failed=False) -> bool:
+        if rerun_failed and not _failed_tests.get(self.window.id()):
+            return False
+        return project_roots.is_cmake_project(self.window)
+
+    @classmethod
+    def description(cls):
+        return "Run Tests"
+
+    def run(self, config: 'Optional[str]' = None, rerun_failed=False) -> None:
+        info = project_roots.load_info(self.window)
+        if info is None:
+            return
+        if rerun_failed:
+            failed = _failed_tests.get(self.window.id())
+            if not failed:
+                self.window.status_message("No failed tests to rerun")
+                return
+            self.__start(info, failed[0], failed[1])
+            return
+        try:
+            configs = sorted(load_target_index(info.build_folder))
+        except (OSError, ValueError, IndexError):
+            sublime.error_message(
+                "No targets found. Please run CMakeBuilder: Configure.")
+            return
+        choose_configuration(self.window, configs, config,
+                             lambda c: self.__start(info, c, None))
+
+    def __start(self, info: 'CmakeInfo', config: str,
+                only: 'Optional[List[str]]') -> None:
+        """Runs all tests, or only the tests with the given names."""
+        settings = info.settings
+        version = cast(dict, capabilities(settings.cmake_binary, "version")
+                       or {})
+        if (version.get("major", 0), version.get("minor", 0)) < (3, 21):
+            sublime.error_message(
+                "Running tests requires CMake 3.21 or newer. Use the "
+                "\"ctest\" build variant instead.")
+            return
+        env = dict(os.environ)
+        env.update(info.env)
+        build_folder = info.build_folder
+        jobs = test_jobs(settings.ctest_parallel_jobs) or os.cpu_count() or 1
+        window = self.window
+
+        def progress(done: int, total: int) -> None:
+            window.status_message(
+                "Running tests: {} of {} shards finished".format(done, total))
+
+        def work() -> None:
+            started = time.time()
+            try:
+                names = list_tests(settings.ctest_binary, config, env,
+                                   build_folder)
+            except (CheckOutputException, OSError, ValueError) as e:
+                sublime.error_message("Unable to list the tests: {}".format(e))
+                return
+            if not names:
+                window.status_message("There are no tests")
+                return
+            selected = None  # type: Optional[List[int]]
+            if only is not None:
+                # Tests may have been added or removed since the last run,
+                # which changes their numbers.
+                wanted = set(only)
+                selected = [i for i, name in enumerate(names, 1)
+                            if name in wanted]
+                if not selected:
+                    window.status_message("No failed tests to rerun")
+                    return
+            results = run_tests(settings.ctest_binary, config, env,
+                                build_folder, names, selected, jobs, progress)
+            _failed_tests[window.id()] = (config, [
+                r["name"] for r in results if r["status"] == "failed"])
+            content = test_results_minihtml(results, time.time() - started)
+            sublime.set_timeout(lambda: window.new_html_sheet(
+                "CMakeBuilder Test Results", content), 0)
+
+        threading.Thread(target=work, daemon=True).start()
+
+
 class CmakeInfo:
-    def __init__(self, window: sublime.Window) -> None:
+    def __init__(
+        self,
+        window: sublime.Window,
+        settings: 'Optional[CmakeSettings]' = None
+    ) -> None:
         self.window = window
+        self.settings = settings if settings else CmakeSettings(window)
+        self.__generator = None  # type: Optional[str]
+        self.__env = None  # type: Optional[Dict[str, str]]
         if not isfile(join(self.root_folder, "CMakeLists.txt")):
             raise FileNotFoundError()
 
-    def __get_val(self, key: str, default: Any = None, expand=True) -> Any:
-        val = get_setting(self.window.active_view(), key, default)
-        if expand:
-            val = expand_vars(self.window, val)
-        return val
-
-    def __get_cmake_binary(self) -> str:
-        return get_cmake_binary(self.window.active_view())
+    @property
+    def cmake_binary(self) -> str:
+        return self.settings.cmake_binary
 
     @property
     def unexpanded_build_folder(self) -> str:
-        return self.__get_val("build_folder", "$folder/build", expand=False)
+        return self.settings.unexpanded_build_folder
 
     @property
     def build_folder(self) -> str:
-        return self.__get_val("build_folder", "$folder/build")
+        return self.settings.build_folder
 
     @property
     def root_folder(self) -> str:
-        return realpath(self.__get_val("root_folder", "$folder"))
+        return self.settings.root_folder
 
     @property
     def overrides(self) -> Dict[str, str]:
-        return self.__get_val("command_line_overrides", {})
+        return self.settings.overrides
 
     @property
     def generator(self) -> str:
-        if sublime.platform() == "windows":
-            cmake_binary = self.__get_cmake_binary()
-            default_gen = get_default_vs_generator_name(cmake_binary)
-        else:
-            default_gen = "Unix Makefiles"
-        return self.__get_val("generator", default_gen)
+        if self.__generator is None:
+            if self.settings.generator:
+                self.__generator = self.settings.generator
+            elif sublime.platform() == "windows":
+                self.__generator = get_default_vs_generator_name(
+                    self.cmake_binary)
+            else:
+                self.__generator = "Unix Makefiles"
+        return self.__generator
 
     @property
     def platform(self) -> Optional[str]:
-        return self.__get_val("generator_platform", None)
+        return self.settings.platform
 
     @property
     def toolset(self) -> Dict[str, str]:
-        return self.__get_val("generator_toolset", {})
+        return self.settings.toolset
 
     @property
     def vs_major_version(self) -> Optional[int]:
-        return self.__get_val("generator_vs_major_version", None)
+        return self.settings.vs_major_version
 
     @property
     def env(self) -> Dict[str, str]:
-        val = self.__get_val("env", {})
-        if sublime.platform() == "windows":
-            val.update(self.__make_vs_environment())
-        return val
+        if self.__env is None:
+            self.__env = dict(self.settings.env)
+            if sublime.platform() == "windows":
+                self.__env.update(self.__make_vs_environment())
+        return dict(self.__env)
 
     def to_command(self) -> 'List[str]':
-        cmd = [self.__get_cmake_binary(), ".", "-B", self.build_folder]
+        cmd = [self.cmake_binary, ".", "-B", self.build_folder]
         if self.generator:
             cmd.extend(["-G", self.generator])
         if self.platform:
@@ -566,12 +2768,61 @@ class CmakeInfo:
             env = get_vs_env(self.vs_major_version, host_arch, target_arch)
         else:
             assert self.generator
-            env = get_vs_env_from_generator_str(self.__get_cmake_binary(),
+            env = get_vs_env_from_generator_str(self.cmake_binary,
                                                 self.generator, host_arch,
                                                 target_arch)
         return env
 
 
+class ProjectRootCache:
+    """Remembers per window whether the root folder has a CMakeLists.txt."""
+
+    def __init__(self) -> None:
+        self.__states = {}  # type: Dict[int, Tuple[Tuple[Any, ...], bool]]
+
+    def __key(self, window: sublime.Window) -> 'Tuple[Any, ...]':
+        return (window.project_file_name(), tuple(window.folders()))
+
+    def is_cmake_project(self, window: sublime.Window) -> bool:
+        state = self.__states.get(window.id())
+        if state is not None and state[0] == self.__key(window):
+            return state[1]
+        return self.load_info(window) is not None
+
+    def load_info(self, window: sublime.Window) -> 'Optional[CmakeInfo]':
+        try:
+            info = CmakeInfo(window)  # type: Optional[CmakeInfo]
+        except FileNotFoundError:
+            info = None
+        self.__states[window.id()] = (self.__key(window), info is not None)
+        return info
+
+    def invalidate(self, window: sublime.Window) -> None:
+        self.__states.pop(window.id(), None)
+
+
+project_roots = ProjectRootCache()
+
+
+class CmakeProjectRootListener(sublime_plugin.EventListener):
+
+    def on_load_project(self, window: sublime.Window) -> None:
+        project_roots.invalidate(window)
+
+    def on_post_save_project(self, window: sublime.Window) -> None:
+        project_roots.invalidate(window)
+
+    def on_pre_close_window(self, window: sublime.Window) -> None:
+        project_roots.invalidate(window)
+
+    def on_post_save(self, view: sublime.View) -> None:
+        file_name = view.file_name()
+        if file_name and os.path.basename(file_name) == "CMakeLists.txt":
+            window = view.window()
+            if window:
+                project_roots.invalidate(window)
+
+
 class CmakeConfigureCommand(ExecCommand):
 
     def __init__(self, window: sublime.Window) -> None:
@@ -584,20 +2835,16 @@ class CmakeConfigureCommand(ExecCommand):
         }  # type: Dict[str, Callable]
 
     def is_enabled(self) -> bool:
-        try:
-            self.info = CmakeInfo(self.window)
-        except FileNotFoundError:
-            return False
-        return True
+        return project_roots.is_cmake_project(self.window)
 
     def description(self) -> str:
         return 'Configure'
 
-    def run(self, kill=False) -> None:
+    def run(self, kill=False, clear_cache: 'Optional[bool]' = None) -> None:
+        self.info = project_roots.load_info(self.window)
         if self.info is None:
-            assert self.is_enabled()
-        assert self.info is not None
-        cmake_binary = get_cmake_binary(self.window.active_view)
+            return
+        cmake_binary = self.info.cmake_binary
         if capabilities(cmake_binary, "fileApi") is None:
             sublime.error_message(
                 " ".join((
@@ -612,13 +2859,13 @@ class CmakeConfigureCommand(ExecCommand):
                 )
             )
             return
-        if get_setting(self.window.active_view(),
-                       "always_clear_cache_before_configure", False):
+        if clear_cache is None:
+            clear_cache = self.info.settings.always_clear_cache_before_configure
+        if clear_cache:
             self.window.run_command("cmake_clear_cache",
                                     {"with_confirmation": False})
         cmd = self.info.to_command()
-        if get_setting(self.window.active_view(),
-                       "silence_developer_warnings", False):
+        if self.info.settings.silence_developer_warnings:
             cmd.append("-Wno-dev")
         write_query(self.window, self.info.build_folder)
         self.window.status_message("Generating build system...")
@@ -636,38 +2883,41 @@ class CmakeConfigureCommand(ExecCommand):
         exit_code = proc.exit_code()
         if exit_code == 0 or exit_code is None:
             self.window.status_message("Translating...")
-            self.__parse_file_api()
-            sublime.set_timeout(self.__write_project_data, 0)
+            threading.Thread(target=self.__translate, daemon=True).start()
         else:
             self.__erase_status()
             log("exited with an error")
 
+    def __translate(self) -> None:
+        self.__parse_file_api()
+        sublime.set_timeout(self.__write_project_data, 0)
+
+    def __report_progress(self, done: int, total: int) -> None:
+        message = "Translating... {}/{} targets".format(done, total)
+        sublime.set_timeout(lambda: self.window.status_message(message), 0)
+
     def __parse_file_api(self):
         if self.info is None:
             raise RuntimeError("missing CMakeInfo data")
         log("parsing file api response")
-        reply = load_reply(self.info.build_folder)
-        responses = reply["reply"][CLIENT_STR]["query.json"]["responses"]
-        for response in responses:
+        reply = load_reply_model(self.info.build_folder)
+        for obj in reply.objects():
             try:
-                self.__handle_response(response)
+                self.__handle_response(obj)
             except Exception as e:
                 sublime.error_message("Error parsing response: {}".format(e))
+        try:
+            save_input_snapshot(self.info.build_folder, reply)
+        except (OSError, ValueError) as e:
+            log("unable to record the cmake inputs:", e)
 
-    def __load_reply_json_file(self, json_file: str) -> dict:
-        assert self.info
-        path = join(file_api_reply(self.info.build_folder), json_file)
-        with open(path, "r") as fp:
-            return json.load(fp)
-
-    def __handle_response(self, response: dict) -> None:
-        data = self.__load_reply_json_file(response["jsonFile"])
-        kind = response["kind"]
-        handler = self.__response_handlers.get(kind)
+    def __handle_response(self, obj: ReplyObject) -> None:
+        handler = self.__response_handlers.get(obj.kind)
         if not handler:
-            log('no response handler installed for "{}"'.format(kind))
+            # Loaded on demand by whoever needs it.
+            log('no response handler installed for "{}"'.format(obj.kind))
             return
-        handler(data)
+        handler(obj.data)
 
     def __handle_response_codemodel(self, data: dict) -> None:
         log("parsing codemodel")
@@ -676,6 +2926,19 @@ class CmakeConfigureCommand(ExecCommand):
         assert self.info
         try:
             configurations = data["configurations"]
+            source_folder = data["paths"]["source"]
+            build_folder = self.info.build_folder
+            summaries = load_target_summaries(
+                file_api_reply(build_folder),
+                [target["jsonFile"]
+                 for configuration in configurations
+                 for target in configuration["targets"]],
+                self.__report_progress,
+                load_cached_target_summaries(build_folder))
+            save_cached_target_summaries(build_folder, summaries)
+            compact = self.info.settings.compact_build_systems
+            target_variants = {}  # type: Dict[str, List[Dict[str, Any]]]
+            target_index = {}  # type: Dict[str, List[Dict[str, Any]]]
             for configuration in configurations:
                 name = configuration["name"]
                 if not name:
@@ -692,50 +2955,77 @@ class CmakeConfigureCommand(ExecCommand):
                 if self.info.generator:
                     build_system["generator"] = self.info.generator
                 targets = configuration["targets"]
+                directories = configuration.get("directories", [])
                 variants = []  # type: List[Dict[str, Any]]
+                entries = []  # type: List[Dict[str, Any]]
                 for target in targets:
-                    data = self.__load_reply_json_file(target["jsonFile"])
+                    data = summaries[target["jsonFile"]]
                     self.__handle_target(variants, name, data)
+                    entries.append(self.__make_index_entry(
+                        target, data, directories))
+                target_variants[name] = list(variants)
+                target_index[name] = entries
+                if compact:
+                    variants = [{"name": "Pick target...",
+                                 "target": "cmake_pick_target"}]
                 variants.append({"name": "ctest", "target": "ctest_run"})
                 build_system["variants"] = variants
                 self.__build_systems.append(build_system)
+            save_target_variants(build_folder, target_variants)
+            save_target_index(build_folder, target_index)
+            save_source_index(build_folder, source_folder, {
+                json_file: summary["name"]
+                for json_file, summary in summaries.items()})
         except Exception as ex:
             self.__error = ex
+            return
+        if self.info.settings.generate_compile_commands and configurations:
+            # compile_commands.json has no configurations; use the first.
+            try:
+                write_compile_commands(
+                    build_folder, source_folder,
+                    [t["jsonFile"] for t in configurations[0]["targets"]])
+            except Exception as ex:
+                log("unable to write compile_commands.json:", ex)
+
+    def __make_index_entry(self, target: dict, data: dict,
+                           directories: 'List[dict]') -> 'Dict[str, Any]':
+        try:
+            directory = directories[target["directoryIndex"]]["source"]
+        except (KeyError, IndexError):
+            directory = ""
+        entry = {"name": data["name"], "type": data["type"],
+                 "directory": directory, "jsonFile": target["jsonFile"]}
+        artifact = executable_artifact(data)
+        if artifact:
+            entry["artifact"] = artifact
+        return entry
 
     def __handle_target(self, variants: 'List[Dict[str, Any]]', config: str,
                         data: dict) -> None:
         name = data["name"]
         log("parsing target", name, "for config", config)
         variants.append({"name": name, "build_target": name})
-        if data["type"] == "EXECUTABLE":
-            artifacts = data["artifacts"]
-            name_on_disk = data["nameOnDisk"]
-            artifacts = [a["path"] for a in artifacts
-                         if a["path"].endswith(name_on_disk)]
-            if len(artifacts) == 0:
-                log("no suitable artifact for target", name)
-                return
-            if len(artifacts) > 1:
-                log("too many candidate artifacts for target", name)
-                return
+        artifact = executable_artifact(data)
+        if artifact:
             variants.append({
                 "name": "Run: " + name,
                 "build_target": name,
                 "target": "cmake_run",
-                "artifact": artifacts[0]})
+                "artifact": artifact})
             if sublime.platform() == "linux":
                 variants.append({
                     "name": "Run under GDB: " + name,
                     "build_target": name,
                     "target": "cmake_run",
-                    "artifact": artifacts[0],
+                    "artifact": artifact,
                     "debug": True})
             elif sublime.platform() == "osx":
                 variants.append({
                     "name": "Run under LLDB: " + name,
                     "build_target": name,
                     "target": "cmake_run",
-                    "artifact": artifacts[0],
+                    "artifact": artifact,
                     "debug": True})
 
     def __write_project_data(self) -> None:
@@ -744,19 +3034,126 @@ class CmakeConfigureCommand(ExecCommand):
                 "Error while configuring project: {}".format(
                     str(self.__error)))
             return
-        log("writing project data")
         data = self.window.project_data()
-
-        def is_not_generated_by_us(d):
-            return "cmake_build" != d.get("target", "foo")
-
-        bs = filter(is_not_generated_by_us, data.get("build_systems", []))
-        data.update({"build_systems": list(bs) + self.__build_systems})
+        build_systems = merge_build_systems(data.get("build_systems", []),
+                                            self.__build_systems)
+        if build_systems is None:
+            log("build systems are up to date")
+            self.window.status_message("Build system is up to date")
+            return
+        log("writing project data")
+        data["build_systems"] = build_systems
         self.window.set_project_data(data)
         self.window.status_message(
             "Generated build system! Select it in [Tools] -> [Build system]")
 
 
+def merge_build_systems(
+    existing: 'List[Dict[str, Any]]',
+    generated: 'List[Dict[str, Any]]'
+) -> 'Optional[List[Dict[str, Any]]]':
+    """Replaces the generated build systems, or returns None if unchanged."""
+    fresh = {bs["name"]: bs for bs in generated}
+    seen = set()
+    changed = False
+    result = []  # type: List[Dict[str, Any]]
+    for bs in existing:
+        if bs.get("target") != "cmake_build":
+            result.append(bs)
+            continue
+        name = bs.get("name")
+        new = fresh.get(name)
+        if new is None or name in seen:
+            log("removing build system", name)
+            changed = True
+            continue
+        seen.add(name)
+        if new != bs:
+            log("updating build system", name)
+            changed = True
+        result.append(new)
+    for name, bs in fresh.items():
+        if name not in seen:
+            log("adding build system", name)
+            changed = True
+            result.append(bs)
+    return result if changed else None
+
+
+class CmakeConfigureIfStaleCommand(sublime_plugin.WindowCommand):
+    """Configures the project, but only if a CMake input file changed."""
+
+    def is_enabled(self) -> bool:
+        return project_roots.is_cmake_project(self.window)
+
+    @classmethod
+    def description(cls):
+        return "Configure If Changed"
+
+    def run(self) -> None:
+        info = project_roots.load_info(self.window)
+        if info is None:
+            return
+        build_folder = info.build_folder
+
+        def check() -> None:
+            stale = find_stale_inputs(build_folder)
+            if stale == []:
+                self.window.status_message("CMake project is up to date")
+                return
+            if stale:
+                log("changed since the last configure:", *stale)
+            # Never clear the cache here; cmake picks up the changes by itself.
+            sublime.set_timeout(lambda: self.window.run_command(
+                "cmake_configure", {"clear_cache": False}), 0)
+
+        sublime.set_timeout_async(check, 0)
+
+
+class CmakeNextErrorCommand(sublime_plugin.WindowCommand):
+    """Goes to the next (or previous) diagnostic of the last build."""
+
+    def is_enabled(self, forward=True) -> bool:
+        index = _diagnostics.get(self.window.id())
+        return index is not None and bool(index.diagnostics)
+
+    def run(self, forward=True) -> None:
+        index = _diagnostics.get(self.window.id())
+        diagnostic = index.step(forward) if index else None
+        if diagnostic is None:
+            self.window.status_message("No diagnostics")
+            return
+        self.window.open_file(
+            "{}:{}:{}".format(diagnostic.file, diagnostic.line,
+                              max(diagnostic.col, 1)),
+            sublime.ENCODED_POSITION)
+        self.window.status_message("{}: {}".format(
+            diagnostic.severity, diagnostic.message))
+
+
+class CmakeDiagnosticsListener(sublime_plugin.EventListener):
+
+    def on_load(self, view: sublime.View) -> None:
+        window = view.window()
+        index = _diagnostics.get(window.id()) if window else None
+        if index is not None:
+            mark_diagnostics(view, index)
+
+
+class CmakeStaleInputsListener(sublime_plugin.EventListener):
+
+    def on_post_save_async(self, view: sublime.View) -> None:
+        file_name = view.file_name()
+        if not file_name:
+            return
+        name = os.path.basename(file_name)
+        if name != "CMakeLists.txt" and not name.endswith(".cmake"):
+            return
+        window = view.window()
+        if window and CmakeSettings(window).reconfigure_on_save:
+            window.run_command("cmake_configure_if_stale")
+
+
 # Note: Things in "CMakeFiles" folders get removed anyway. This is where you put
 # files that should be removed but are not inside CMakeFiles folders.
 TRY_TO_REMOVE = [
@@ -765,101 +3162,311 @@ TRY_TO_REMOVE = [
 ]
 
 
+# CMakeFiles is renamed to this (plus a unique suffix) and deleted afterwards.
+TOMBSTONE_PREFIX = "CMakeFiles.removed-"
+
+
+def format_size(size: int) -> str:
+    if size < 1024:
+        return "{} bytes".format(size)
+    value = float(size)
+    for unit in ("KB", "MB", "GB"):
+        value /= 1024
+        if value < 1024:
+            break
+    return "{:.1f} {}".format(value, unit)
+
+
+def measure_tree(path: str) -> 'Tuple[int, int]':
+    """Returns the number of files below path and their total size."""
+    count = size = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    c, s = measure_tree(entry.path)
+                    count += c
+                    size += s
+                else:
+                    count += 1
+                    size += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return count, size
+
+
+def remove_tree(path: str, errors: 'List[str]') -> 'Tuple[int, int]':
+    """Removes path and everything below it, returning the count and size."""
+    count = size = 0
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError as e:
+        errors.append("{}: {}".format(path, e.strerror))
+        return count, size
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                c, s = remove_tree(entry.path, errors)
+                count += c
+                size += s
+                continue
+            s = entry.stat(follow_symlinks=False).st_size
+            os.remove(entry.path)
+            count += 1
+            size += s
+        except OSError as e:
+            errors.append("{}: {}".format(entry.path, e.strerror))
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        errors.append("{}: {}".format(path, e.strerror))
+    return count, size
+
+
+def remove_trees(paths: 'List[str]', errors: 'List[str]') -> 'Tuple[int, int]':
+    """Removes the given directory trees, one subdirectory per worker."""
+    count = size = 0
+    subdirs = []  # type: List[str]
+    for path in paths:
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    s = entry.stat(follow_symlinks=False).st_size
+                    os.remove(entry.path)
+                    count += 1
+                    size += s
+        except OSError as e:
+            errors.append("{}: {}".format(path, e.strerror))
+    if subdirs:
+        workers = min(32, (os.cpu_count() or 1) + 4, len(subdirs))
+        # Every task gets its own error list, so no lock is needed.
+        task_errors = [[] for _ in subdirs]  # type: List[List[str]]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(remove_tree, subdir, subdir_errors)
+                       for subdir, subdir_errors in zip(subdirs, task_errors)]
+            for future in futures:
+                c, s = future.result()
+                count += c
+                size += s
+        for subdir_errors in task_errors:
+            errors.extend(subdir_errors)
+    for path in paths:
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            errors.append("{}: {}".format(path, e.strerror))
+    return count, size
+
+
 class CmakeClearCacheCommand(sublime_plugin.WindowCommand):
     """Clears the CMake-generated files"""
 
     def is_enabled(self):
-        try:
-            self.info = CmakeInfo(self.window)
-        except FileNotFoundError:
-            return False
-        return True
+        return project_roots.is_cmake_project(self.window)
 
     @classmethod
     def description(cls):
         return 'Clear Cache'
 
     def run(self, with_confirmation=True):
-        assert self.info
-        build_folder = self.info.build_folder
-        files_to_remove = []
-        dirs_to_remove = []
-        cmakefiles_dir = os.path.join(build_folder, 'CMakeFiles')
-        if os.path.exists(cmakefiles_dir):
-            for root, dirs, files in os.walk(cmakefiles_dir, topdown=False):
-                files_to_remove.extend(
-                    [os.path.join(root, name) for name in files])
-                dirs_to_remove.extend(
-                    [os.path.join(root, name) for name in dirs])
-            dirs_to_remove.append(cmakefiles_dir)
-
-        def append_file_to_remove(relative_name):
-            abs_path = os.path.join(build_folder, relative_name)
-            if os.path.exists(abs_path):
-                files_to_remove.append(abs_path)
-
-        for file in TRY_TO_REMOVE:
-            append_file_to_remove(file)
-
+        info = project_roots.load_info(self.window)
+        if info is None:
+            return
+        build_folder = info.build_folder
         if not with_confirmation:
-            self.remove(files_to_remove, dirs_to_remove)
+            self.clear(build_folder)
             return
+        sublime.set_timeout_async(lambda: self.confirm(build_folder), 0)
 
-        panel = self.window.create_output_panel('files_to_be_deleted')
-
-        self.window.run_command('show_panel',
-                                {'panel': 'output.files_to_be_deleted'})
-
-        panel.run_command('insert',
-                          {'characters': 'Files to remove:\n' +
-                           '\n'.join(files_to_remove + dirs_to_remove)})
+    def confirm(self, build_folder: str) -> None:
+        count, size = measure_tree(join(build_folder, "CMakeFiles"))
+        for file in TRY_TO_REMOVE:
+            try:
+                size += os.stat(join(build_folder, file)).st_size
+                count += 1
+            except OSError:
+                pass
+        if count == 0:
+            self.window.status_message("There is no CMake cache to clear")
+            return
+        summary = "Remove {} files ({}) from {}".format(
+            count, format_size(size), build_folder)
 
-        def on_done(selected):
-            if selected != 0:
-                return
-            self.remove(files_to_remove, dirs_to_remove)
-            panel.run_command('append',
-                              {'characters': '\nCleared CMake cache files!',
-                               'scroll_to_end': True})
+        def on_done(selected: int) -> None:
+            if selected == 0:
+                self.clear(build_folder)
 
-        self.window.show_quick_panel(['Do it', 'Cancel'], on_done,
-                                     sublime.KEEP_OPEN_ON_FOCUS_LOST)
+        sublime.set_timeout(lambda: self.window.show_quick_panel(
+            [["Do it", summary], ["Cancel", "Keep the cache"]], on_done,
+            sublime.KEEP_OPEN_ON_FOCUS_LOST), 0)
 
-    def remove(self, files_to_remove, dirs_to_remove):
-        for file in files_to_remove:
+    def clear(self, build_folder: str) -> None:
+        """Removes the cache files and deletes CMakeFiles in the background."""
+        errors = []  # type: List[str]
+        count = size = 0
+        for file in TRY_TO_REMOVE:
+            path = join(build_folder, file)
             try:
-                os.remove(file)
-            except Exception:
-                sublime.error_message('Cannot remove '+file)
-        for directory in dirs_to_remove:
+                size += os.stat(path).st_size
+                os.remove(path)
+                count += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors.append("{}: {}".format(path, e.strerror))
+        in_place = []  # type: List[str]
+        cmakefiles_dir = join(build_folder, "CMakeFiles")
+        if os.path.isdir(cmakefiles_dir):
+            tombstone = join(build_folder, "{}{}".format(
+                TOMBSTONE_PREFIX, time.time_ns()))
+            try:
+                os.rename(cmakefiles_dir, tombstone)
+            except OSError as e:
+                # Probably a file is in use. Delete what we can in place, so
+                # that a subsequent configure does not see a stale tree.
+                log("unable to move CMakeFiles:", e)
+                in_place.append(cmakefiles_dir)
+
+        def remove_tombstones() -> None:
+            nonlocal count, size
             try:
-                os.rmdir(directory)
-            except Exception:
-                sublime.error_message('Cannot remove '+directory)
+                with os.scandir(build_folder) as it:
+                    tombstones = [entry.path for entry in it
+                                  if entry.name.startswith(TOMBSTONE_PREFIX)]
+            except OSError as e:
+                # For instance, the build folder does not exist yet.
+                log("unable to look for old CMakeFiles folders:", e)
+                tombstones = []
+            c, s = remove_trees(in_place + tombstones, errors)
+            count += c
+            size += s
+            sublime.set_timeout(report, 0)
+
+        def report() -> None:
+            self.window.status_message(
+                "Cleared CMake cache: removed {} files ({})".format(
+                    count, format_size(size)))
+            if errors:
+                shown = errors[:20]
+                if len(errors) > len(shown):
+                    shown.append("... and {} more".format(
+                        len(errors) - len(shown)))
+                sublime.error_message(
+                    "Could not remove {} files:\n\n{}".format(
+                        len(errors), "\n".join(shown)))
+
+        threading.Thread(target=remove_tombstones, daemon=True).start()
 
 
 class CmakeOpenBuildFolderCommand(sublime_plugin.WindowCommand):
     """Opens the build folder."""
 
     def is_enabled(self) -> bool:
-        try:
-            self.info = CmakeInfo(self.window)
-        except FileNotFoundError:
-            return False
-        return True
+        return project_roots.is_cmake_project(self.window)
 
     @classmethod
     def description(cls):
         return "Browse Build Folder..."
 
     def run(self):
-        if not self.info:
-            if not self.is_enabled():
-                return
-        args = {"dir": realpath(self.info.build_folder)}
+        info = project_roots.load_info(self.window)
+        if info is None:
+            return
+        args = {"dir": realpath(info.build_folder)}
         self.window.run_command("open_dir", args=args)
 
 
+class CmakeRefreshVsEnvironmentsCommand(sublime_plugin.WindowCommand):
+    """Forgets the cached Visual Studio environments and installations."""
+
+    def is_visible(self) -> bool:
+        return sublime.platform() == "windows"
+
+    @classmethod
+    def description(cls):
+        return "Refresh Visual Studio Environments"
+
+    def run(self):
+        vs_environments.clear()
+        toolchains.clear()
+        sublime.set_timeout_async(discover_toolchains, 0)
+        self.window.status_message("Cleared cached Visual Studio environments")
+
+
+def format_ms(ms: int) -> str:
+    if ms < 1000:
+        return "{} ms".format(ms)
+    if ms < 60000:
+        return "{:.1f} s".format(ms / 1000)
+    return "{}m {:.0f}s".format(ms // 60000, (ms % 60000) / 1000)
+
+
+def profile_minihtml(profile: 'Dict[str, Any]') -> str:
+    wall = profile["wall"]
+    parallelism = profile["busy"] / wall if wall else 0
+    result = ["<h1>Build Profile</h1>", "<ul>"]
+    result.extend([
+        "<li>", "Edges: ", str(profile["edges"]), "</li>",
+        "<li>", "Wall time: ", format_ms(wall), "</li>",
+        "<li>", "Sum of edge times: ", format_ms(profile["busy"]), "</li>",
+        "<li>", "Average parallelism: {:.1f} (peak {})".format(
+            parallelism, profile["peak"]), "</li>",
+        "</ul>"])
+    result.append("<h2>Critical path</h2><ul>")
+    for e in profile["critical_path"]:
+        result.extend(["<li>", format_ms(e.duration), " ",
+                       escape(e.outputs[0]), "</li>"])
+    result.append("</ul><h2>Targets</h2><ul>")
+    for name, (total, count) in profile["targets"]:
+        result.extend([
+            "<li>", escape(name), ": ", format_ms(total), " in ", str(count),
+            " edges ({:.0f}%)".format(100 * total / profile["busy"]
+                                      if profile["busy"] else 0), "</li>"])
+    result.append("</ul><h2>Slowest edges</h2><ul>")
+    for e in profile["slowest"]:
+        result.extend(["<li>", format_ms(e.duration), " ",
+                       escape(e.outputs[0]), "</li>"])
+    result.append("</ul>")
+    return "".join(result)
+
+
+class CmakeBuildProfileCommand(sublime_plugin.WindowCommand):
+    """Shows where the time of the last Ninja build went."""
+
+    def is_enabled(self) -> bool:
+        return project_roots.is_cmake_project(self.window)
+
+    @classmethod
+    def description(cls):
+        return "Build Profile"
+
+    def run(self) -> None:
+        info = project_roots.load_info(self.window)
+        if info is None:
+            return
+        build_folder = info.build_folder
+        if not isfile(join(build_folder, ".ninja_log")):
+            sublime.error_message(
+                "There is no .ninja_log in {}. Build profiles are only "
+                "available for the Ninja generators.".format(build_folder))
+            return
+
+        def show() -> None:
+            profile = build_profile(build_folder)
+            if not profile["edges"]:
+                self.window.status_message("The last build did nothing")
+                return
+            content = profile_minihtml(profile)
+            sublime.set_timeout(lambda: self.window.new_html_sheet(
+                "CMakeBuilder Build Profile", content), 0)
+
+        sublime.set_timeout_async(show, 0)
+
+
 class Diag:
     def __init__(self, check_name: str, ok_value: str, error_suggestion: str) -> None:
         self.__check_name: str = check_name
@@ -897,8 +3504,9 @@ class Diag:
 
 class CmakeInsertDiagnosis:
 
-    def __init__(self, view: sublime.View) -> None:
+    def __init__(self, view: sublime.View, settings: CmakeSettings) -> None:
         self.view = view
+        self.settings = settings
 
     def run(self):
         self.__table: List[Diag] = []
@@ -908,10 +3516,12 @@ class CmakeInsertDiagnosis:
             pass
         elif not self.__check_cmake_settings():
             pass
+        elif not self.__check_reply():
+            pass
         return tabulate(self.__table)
 
     def __check_cmake_binary(self) -> bool:
-        self.__table.append(Diag("cmake binary", get_cmake_binary(self.view), ""))
+        self.__table.append(Diag("cmake binary", self.settings.cmake_binary, ""))
         return True
 
     def __append(self, info: str, val: Any, suggestion: str) -> None:
@@ -925,7 +3535,7 @@ class CmakeInsertDiagnosis:
         self.__append(key, "", suggestion)
 
     def __check_cmake_version(self) -> bool:
-        cmake_binary = get_cmake_binary(self.view)
+        cmake_binary = self.settings.cmake_binary
         try:
             output = check_output(
                 "{} --version".format(cmake_binary)).splitlines()[0][14:]
@@ -946,7 +3556,7 @@ class CmakeInsertDiagnosis:
         try:
             window = self.view.window()
             if window:
-                info = CmakeInfo(window)
+                info = CmakeInfo(window, self.settings)
             else:
                 raise RuntimeError("failed to load window")
         except FileNotFoundError:
@@ -962,6 +3572,24 @@ class CmakeInsertDiagnosis:
         if info.vs_major_version:
             self.__ok("selected vs major ver", info.vs_major_version)
         self.__ok("command to be run", info)
+        self.__info = info
+        return True
+
+    def __check_reply(self) -> bool:
+        try:
+            reply = load_reply_model(self.__info.build_folder)
+        except (OSError, ValueError, IndexError):
+            self.__fail("configured", "Run CMakeBuilder: Configure")
+            return False
+        self.__ok("generator in use", reply.generator_name)
+        if reply.cache:
+            build_type = reply.cache.get("CMAKE_BUILD_TYPE")
+            if build_type:
+                self.__ok("CMAKE_BUILD_TYPE", build_type)
+        if reply.toolchains:
+            compilers = reply.toolchains.compiler_paths()
+            for language, path in sorted(compilers.items()):
+                self.__ok("{} compiler".format(language), path)
         return True
 
 
@@ -973,7 +3601,7 @@ class CmakeDiagnoseCommand(sublime_plugin.WindowCommand):
             return
         self.window.new_html_sheet(
             "CMakeBuilder Diagnosis",
-            CmakeInsertDiagnosis(view).run()
+            CmakeInsertDiagnosis(view, CmakeSettings(self.window)).run()
         )
 
     @classmethod
@@ -987,3 +3615,7 @@ def tabulate(data: List[Diag]) -> str:
     for item in data:
         result.extend(item.minihtml())
     return "".join(result)
+
+
+def plugin_loaded() -> None:
+    sublime.set_timeout_async(discover_toolchains, 0)